@@ -0,0 +1,475 @@
+import base64
+import binascii
+import hashlib
+import json
+import re
+from datetime import datetime
+from flask import Blueprint, Response, request, jsonify
+from flask_restful import Api, Resource, abort
+from flask_jwt_extended import (
+    jwt_required, get_jwt_identity, create_access_token, create_refresh_token
+)
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import joinedload, selectinload
+from data import metrics
+from data.db_session import get_session
+from data.__all_models import User, Product, Category, Order, OrderItem
+from data.cache import cart_count_cache, catalog_cache, get_catalog_version
+from data.cart import add_item, set_item_quantity, get_cart_totals, get_cart_lines, CartError
+from data.checkout import place_order, CheckoutError
+from data.images import product_image_url, IMAGE_SIZES
+from data.search import search_products
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+PRODUCT_FIELDS = {'id', 'sku', 'name', 'description', 'price', 'stock_quantity', 'category', 'images'}
+CART_ITEM_FIELDS = {'id', 'quantity', 'line_total', 'product'}
+ORDER_FIELDS = {'id', 'created_at', 'status', 'total_amount', 'promo_code', 'items_count'}
+
+api_v1 = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+
+class ApiV1(Api):
+    # Ошибки токена обрабатывает JWTManager; Flask-RESTful иначе превратил
+    # бы их в 500
+    def handle_error(self, e):
+        if isinstance(e, (JWTExtendedException, PyJWTError)):
+            raise e
+        return super().handle_error(e)
+
+
+api = ApiV1(api_v1)
+
+
+def current_user_id():
+    return int(get_jwt_identity())
+
+
+def get_limit():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        abort(400, error='Некорректный limit')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(*types):
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError(cursor)
+        return [convert(value) for convert, value in zip(types, values)]
+    except (binascii.Error, TypeError, ValueError):
+        abort(400, error='Некорректный cursor')
+
+
+def get_fields(allowed):
+    # ?fields=id,name,price — в ответе останутся только эти поля
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = {field.strip() for field in fields.split(',') if field.strip()}
+    unknown = fields - allowed
+    if unknown:
+        abort(400, error=f'Неизвестные поля: {", ".join(sorted(unknown))}')
+    return fields
+
+
+def pick(data, fields):
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def not_modified(etag):
+    # Проверка до загрузки данных: если клиент уже видел эту версию,
+    # отвечаем 304 без запросов к базе за содержимым
+    if etag and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def catalog_etag(*parts):
+    # Данные каталога меняются только вместе с его версией, поэтому ETag
+    # известен до выполнения запросов
+    return make_etag(get_catalog_version(get_session()), request.path, request.query_string, *parts)
+
+
+def conditional_json(data, etag=None, private=False):
+    response = jsonify(data)
+    if etag:
+        response.set_etag(etag)
+    else:
+        response.add_etag()
+    if private:
+        response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def serialize_product(product):
+    return {
+        'id': product.id,
+        'sku': product.sku,
+        'name': product.name,
+        'description': product.description or '',
+        'price': float(product.price),
+        'stock_quantity': product.stock_quantity,
+        'category': {'id': product.category.id, 'name': product.category.name} if product.category else None,
+        'images': {
+            size: product_image_url(product.image_url, size, 'webp')
+            for size in IMAGE_SIZES
+        } if product.image_url else None
+    }
+
+
+def serialize_order(row):
+    return {
+        'id': row.id,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+        'status': row.status,
+        'total_amount': float(row.total_amount),
+        'promo_code': row.promo_code,
+        'items_count': int(row.items_count)
+    }
+
+
+def cart_payload(db, user_id, fields):
+    totals = get_cart_totals(db, user_id)
+    return {
+        'version': totals.version,
+        'subtotal': float(totals.subtotal),
+        'items_count': totals.items_count,
+        'items': [
+            pick({
+                'id': line['id'],
+                'quantity': line['quantity'],
+                'line_total': float(line['line_total']),
+                'product': {
+                    'id': line['product']['id'],
+                    'name': line['product']['name'],
+                    'price': float(line['product']['price']),
+                    'stock_quantity': line['product']['stock_quantity'],
+                    'image': product_image_url(line['product']['image_url'], 'thumb', 'webp')
+                    if line['product']['image_url'] else None
+                }
+            }, fields)
+            for line in get_cart_lines(db, totals.cart_id)
+        ]
+    }
+
+
+class TokenResource(Resource):
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        db = get_session()
+        user = db.query(User).filter_by(email=data.get('email', '')).first()
+        if not user or user.password != data.get('password'):
+            return {'error': 'Неверный email или пароль'}, 401
+
+        identity = str(user.id)
+        return {
+            'access_token': create_access_token(identity=identity),
+            'refresh_token': create_refresh_token(identity=identity)
+        }
+
+
+class RefreshResource(Resource):
+    @jwt_required(refresh=True)
+    def post(self):
+        return {'access_token': create_access_token(identity=get_jwt_identity())}
+
+
+class CategoryListResource(Resource):
+    def get(self):
+        db = get_session()
+        version = get_catalog_version(db)
+        etag = make_etag('categories', version)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        categories = catalog_cache.get((version, 'categories'))
+        if categories is None:
+            categories = [
+                {'id': category_id, 'name': name}
+                for category_id, name in db.query(Category.id, Category.name).order_by(Category.id)
+            ]
+            catalog_cache.set((version, 'categories'), categories)
+        return conditional_json({'items': categories}, etag=etag)
+
+
+class ProductListResource(Resource):
+    def get(self):
+        fields = get_fields(PRODUCT_FIELDS)
+        limit = get_limit()
+        cursor = decode_cursor(int)
+        category_id = request.args.get('category_id', type=int)
+        query_text = request.args.get('q', '').strip()
+        db = get_session()
+        etag = catalog_etag()
+        response = not_modified(etag)
+        if response:
+            return response
+
+        next_cursor = None
+        if query_text:
+            # Результаты поиска упорядочены сначала по совпадению в названии,
+            # поэтому курсор хранит смещение
+            offset = cursor[0] if cursor else 0
+            products, _ = search_products(
+                db, query_text, category_id=category_id, limit=limit + 1, offset=offset, with_total=False
+            )
+            if len(products) > limit:
+                products = products[:limit]
+                next_cursor = encode_cursor(offset + limit)
+        else:
+            query = db.query(Product).options(joinedload(Product.category))
+            if category_id:
+                query = query.filter(Product.category_id == category_id)
+            if cursor:
+                query = query.filter(Product.id > cursor[0])
+            products = query.order_by(Product.id).limit(limit + 1).all()
+            if len(products) > limit:
+                products = products[:limit]
+                next_cursor = encode_cursor(products[-1].id)
+
+        return conditional_json({
+            'items': [pick(serialize_product(product), fields) for product in products],
+            'next_cursor': next_cursor
+        }, etag=etag)
+
+
+class ProductResource(Resource):
+    def get(self, product_id):
+        fields = get_fields(PRODUCT_FIELDS)
+        etag = catalog_etag()
+        response = not_modified(etag)
+        if response:
+            return response
+
+        product = get_session().query(Product).options(joinedload(Product.category)).get(product_id)
+        if not product:
+            abort(404, error='Товар не найден')
+        return conditional_json(pick(serialize_product(product), fields), etag=etag)
+
+
+class CartResource(Resource):
+    @jwt_required()
+    def get(self):
+        fields = get_fields(CART_ITEM_FIELDS)
+        user_id = current_user_id()
+        db = get_session()
+
+        # Версия корзины меняется при любом изменении, поэтому ETag
+        # считается по ней без загрузки позиций
+        totals = get_cart_totals(db, user_id)
+        etag = make_etag('cart', totals.cart_id, totals.version, sorted(fields or ()))
+        response = not_modified(etag)
+        if response:
+            return response
+        return conditional_json(cart_payload(db, user_id, fields), etag=etag, private=True)
+
+
+class CartItemListResource(Resource):
+    @jwt_required()
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        try:
+            product_id = int(data.get('product_id'))
+        except (TypeError, ValueError):
+            return {'error': 'Не указан product_id'}, 400
+
+        user_id = current_user_id()
+        db = get_session()
+        try:
+            quantity = add_item(db, user_id, product_id)
+            db.commit()
+        except CartError as e:
+            db.rollback()
+            return {'error': e.message, 'reason': e.reason}, 409
+
+        cart_count_cache.invalidate(user_id)
+        totals = get_cart_totals(db, user_id)
+        return {
+            'product_id': product_id,
+            'quantity': quantity,
+            'version': totals.version,
+            'subtotal': float(totals.subtotal),
+            'items_count': totals.items_count
+        }, 201
+
+
+class CartItemResource(Resource):
+    @jwt_required()
+    def patch(self, item_id):
+        data = request.get_json(silent=True) or {}
+        try:
+            quantity = int(data.get('quantity'))
+        except (TypeError, ValueError):
+            return {'error': 'Не указано количество'}, 400
+        return self._set_quantity(item_id, quantity)
+
+    @jwt_required()
+    def delete(self, item_id):
+        return self._set_quantity(item_id, 0)
+
+    def _set_quantity(self, item_id, quantity):
+        user_id = current_user_id()
+        db = get_session()
+        try:
+            quantity = set_item_quantity(db, user_id, item_id, quantity)
+            db.commit()
+        except CartError as e:
+            db.rollback()
+            return {'error': e.message, 'reason': e.reason}, 404 if e.reason == 'not_found' else 409
+
+        cart_count_cache.invalidate(user_id)
+        totals = get_cart_totals(db, user_id)
+        return {
+            'id': item_id,
+            'quantity': quantity,
+            'version': totals.version,
+            'subtotal': float(totals.subtotal),
+            'items_count': totals.items_count
+        }
+
+
+class CheckoutResource(Resource):
+    @jwt_required()
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        db = get_session()
+        user = db.query(User).get(current_user_id())
+        if not user:
+            return {'error': 'Пользователь не найден'}, 404
+        if not user.phone or not re.match(r'^\+7\d{10}$', user.phone):
+            return {'error': 'Проверьте номер телефона в профиле', 'reason': 'invalid_phone'}, 400
+
+        missing = [field for field in ('country', 'city', 'street', 'house') if not str(data.get(field) or '').strip()]
+        if missing:
+            return {'error': f'Не заполнены поля: {", ".join(missing)}', 'reason': 'invalid_address'}, 400
+        address = {
+            'country': data['country'],
+            'city': data['city'],
+            'street': data['street'],
+            'house': data['house'],
+            'apartment': data.get('apartment', ''),
+            'additional_info': data.get('additional_info', '')
+        }
+
+        try:
+            order, warnings = place_order(db, user, address, str(data.get('promo_code') or '').strip().upper())
+            db.commit()
+        except CheckoutError as e:
+            db.rollback()
+            metrics.record_checkout(failure=e.reason)
+            return {'error': e.message, 'reason': e.reason}, 409
+
+        metrics.record_checkout(order, warnings)
+
+        cart_count_cache.invalidate(user.id)
+        return {
+            'id': order.id,
+            'status': order.status,
+            'total_amount': float(order.total_amount),
+            'promo_code': order.promo_code,
+            'warnings': [{'message': message, 'reason': reason} for message, reason in warnings]
+        }, 201
+
+
+class OrderListResource(Resource):
+    @jwt_required()
+    def get(self):
+        fields = get_fields(ORDER_FIELDS)
+        limit = get_limit()
+        cursor = decode_cursor(datetime.fromisoformat, int)
+        db = get_session()
+
+        query = db.query(
+            Order.id, Order.created_at, Order.status, Order.total_amount, Order.promo_code,
+            func.coalesce(func.sum(OrderItem.quantity), 0).label('items_count')
+        ).outerjoin(OrderItem, OrderItem.order_id == Order.id).filter(Order.user_id == current_user_id())
+        if cursor:
+            query = query.filter(tuple_(Order.created_at, Order.id) < tuple_(*cursor))
+
+        rows = query.group_by(Order.id).order_by(
+            Order.created_at.desc(), Order.id.desc()
+        ).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].created_at.isoformat(), rows[-1].id)
+
+        return conditional_json({
+            'items': [pick(serialize_order(row), fields) for row in rows],
+            'next_cursor': next_cursor
+        }, private=True)
+
+
+class OrderResource(Resource):
+    @jwt_required()
+    def get(self, order_id):
+        order = get_session().query(Order).options(
+            selectinload(Order.items).joinedload(OrderItem.product),
+            selectinload(Order.delivery_address)
+        ).filter_by(id=order_id, user_id=current_user_id()).first()
+        if not order:
+            abort(404, error='Заказ не найден')
+
+        address = order.delivery_address
+        return conditional_json({
+            'id': order.id,
+            'created_at': order.created_at.isoformat() if order.created_at else None,
+            'status': order.status,
+            'total_amount': float(order.total_amount),
+            'promo_code': order.promo_code,
+            'items': [
+                {
+                    'product_id': item.product_id,
+                    'name': item.product.name if item.product else None,
+                    'quantity': item.quantity,
+                    'price': float(item.price_at_purchase)
+                }
+                for item in order.items
+            ],
+            'delivery_address': {
+                'country': address.country,
+                'city': address.city,
+                'street': address.street,
+                'house': address.house,
+                'apartment': address.apartment,
+                'additional_info': address.additional_info,
+                'phone': address.phone
+            } if address else None
+        }, private=True)
+
+
+api.add_resource(TokenResource, '/auth/token')
+api.add_resource(RefreshResource, '/auth/refresh')
+api.add_resource(CategoryListResource, '/categories')
+api.add_resource(ProductListResource, '/products')
+api.add_resource(ProductResource, '/products/<int:product_id>')
+api.add_resource(CartResource, '/cart')
+api.add_resource(CartItemListResource, '/cart/items')
+api.add_resource(CartItemResource, '/cart/items/<int:item_id>')
+api.add_resource(CheckoutResource, '/checkout')
+api.add_resource(OrderListResource, '/orders')
+api.add_resource(OrderResource, '/orders/<int:order_id>')
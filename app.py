@@ -1,45 +1,48 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from data.db_session import get_db
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g
+from flask import Response, stream_with_context, send_from_directory
+from flask_jwt_extended import JWTManager
+from data import db_session
+from data.db_session import get_session, init_app
+from data import profiler, metrics
+from data.migrations import check_query_plans
+from data.cache import cart_count_cache, catalog_cache, get_catalog_version
+from data.search import search_products
+from data.checkout import place_order, CheckoutError
+from data.promo import evaluate_promo, apply_discount, invalidate_promos, PromoError
+from data.cart import add_item, set_item_quantity, CartError, get_cart_totals, get_cart_lines, touch_carts
+from data.images import save_image, is_image_key, product_image_url, IMAGE_SIZES, IMAGE_FORMATS
+from data.reservations import release_products, sweep_reservations, start_sweeper
+from data import analytics, jobs, tasks
+from data.fragments import FragmentCacheExtension
+from data.timeutils import to_utc, format_local, format_local_column
+from data.catalog_io import read_rows, import_products, iter_export, detect_format, IMPORT_BATCH_SIZE
+from api.v1 import api_v1
 from data.__all_models import User, Product, Category, Cart, CartItem, Order, OrderItem, DeliveryAddress, PromoCode
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload, aliased
+from sqlalchemy import func, tuple_, select, or_
 import os
-import pytz
+import click
+import hashlib
+import threading
 import re
 from datetime import datetime
 from functools import wraps
-from flask import abort
+from flask import abort, make_response
+from markupsafe import Markup
+from jinja2 import FileSystemBytecodeCache
 from decimal import Decimal
 
 
 def calculate_cart_total(user_id):
-    db = next(get_db())
-    try:
-        cart = db.query(Cart).options(
-            joinedload(Cart.items).joinedload(CartItem.product)
-        ).filter_by(user_id=user_id).first()
-
-        if not cart or not cart.items:
-            return 0
-
-        return sum(
-            item.product.price * item.quantity
-            for item in cart.items
-        )
-    except Exception as e:
-        app.logger.error(f"Error calculating cart total: {str(e)}")
-        return 0
-    finally:
-        db.close()
+    return get_cart_totals(get_session(), user_id).subtotal
 
 
 def is_admin():
     if 'user_id' not in session:
         return False
-    db = next(get_db())
-    user = db.query(User).get(session['user_id'])
-    db.close()
-    return user and user.is_admin
+    user = get_header_context()['current_user']
+    return bool(user and user.is_admin)
 
 
 def admin_required(f):
@@ -52,10 +55,55 @@ def admin_required(f):
     return decorated_function
 
 
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
-app = Flask(__name__)
-app.secret_key = 'your_very_secret_key_here'
-app.config['UPLOAD_FOLDER'] = os.path.join('static', 'img', 'products')
+_background_started = False
+_background_lock = threading.Lock()
+
+
+def start_background_tasks():
+    # Сборщик резервов и обработчики очереди работают в каждом процессе
+    # приложения; задачи забираются атомарно, поэтому процессов может быть
+    # несколько
+    start_sweeper(db_session.SessionLocal)
+    jobs.start_workers(db_session.SessionLocal)
+
+
+def _start_background_tasks_once():
+    # Потоки запускаются первым запросом, а не при импорте: CLI-команды их не
+    # запускают, а под gunicorn они стартуют в воркерах уже после fork
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if not _background_started:
+            _background_started = True
+            if os.environ.get('BACKGROUND_TASKS', '1') != '0':
+                start_background_tasks()
+
+
+def create_app():
+    # Импорт приложения не подключается к базе и не запускает потоков: движок
+    # создаётся при первом запросе к базе, схему создаёт flask migrate
+    app = Flask(__name__)
+    app.secret_key = 'your_very_secret_key_here'
+    app.config['UPLOAD_FOLDER'] = os.path.join('static', 'img', 'products')
+    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', app.secret_key)
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.environ.get('STATIC_MAX_AGE', 3600))
+    # Скомпилированные шаблоны сохраняются на диск (по умолчанию во временный
+    # каталог), и новые воркеры не компилируют их заново
+    if os.environ.get('JINJA_CACHE_DIR'):
+        os.makedirs(os.environ['JINJA_CACHE_DIR'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ.get('JINJA_CACHE_DIR'))
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    init_app(app)
+    profiler.init_profiler(app)
+    metrics.init_metrics(app, lambda: db_session.engine)
+    JWTManager(app)
+    app.register_blueprint(api_v1)
+    app.before_request(_start_background_tasks_once)
+    return app
+
+
+app = create_app()
 
 
 def format_phone_number(phone):
@@ -80,62 +128,96 @@ def regex_match(value, pattern):
 app.jinja_env.tests['regex_match'] = regex_match
 
 
-@app.context_processor
-def inject_cart_items_count():
-    if 'user_id' in session:
-        try:
-            db = next(get_db())
-            cart = db.query(Cart).filter_by(user_id=session['user_id']).first()
-            if cart:
-                count = sum(item.quantity for item in cart.items)
-                return {'cart_items_count': count}
-        except:
-            pass
-    return {'cart_items_count': 0}
+# Варианты изображений называются по хэшу содержимого и никогда не меняются,
+# поэтому браузер может кэшировать их без повторных запросов
+IMAGE_MAX_AGE = 365 * 24 * 3600
+_VARIANT_RE = re.compile(rf"[0-9a-f]+-({'|'.join(IMAGE_SIZES)})\.({'|'.join(IMAGE_FORMATS)})")
 
 
-@app.context_processor
-def inject_timezone():
-    return {'tz': MOSCOW_TZ}
+def product_image_folder():
+    return os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
 
 
-@app.context_processor
-def inject_user():
-    if 'user_id' in session:
-        db = next(get_db())
-        user = db.query(User).get(session['user_id'])
-        return {'current_user': user}
-    return {'current_user': None}
+def store_uploaded_image():
+    upload = request.files.get('image')
+    if not upload or not upload.filename:
+        return None
+    return save_image(upload.stream, product_image_folder())
+
+
+def release_image(db, image_url):
+    # Файлы удаляет задача очереди, если изображение больше ни у кого не
+    # используется; вызывать до commit, чтобы задача попала в ту же транзакцию
+    tasks.release_image(db, product_image_folder(), image_url)
+
+
+def delete_products(db, products):
+    # Корзины и резервы чистятся сразу, позиции заказов и файлы изображений —
+    # задачей очереди. Сами товары удаляются массово, без ORM-каскада,
+    # который загрузил бы все позиции заказов.
+    product_ids = [product.id for product in products]
+    touch_carts(db, product_ids=product_ids)
+    db.query(CartItem).filter(CartItem.product_id.in_(product_ids)).delete(synchronize_session=False)
+    release_products(db, product_ids)
+    tasks.purge_products_later(db, products, product_image_folder())
+    db.query(Product).filter(Product.id.in_(product_ids)).delete(synchronize_session=False)
+
+
+app.jinja_env.filters['product_image'] = product_image_url
+app.jinja_env.filters['localtime'] = format_local
+app.jinja_env.filters['localtime_column'] = format_local_column
+app.jinja_env.tests['image_key'] = is_image_key
+
+
+@app.route('/img/products/<filename>')
+def product_image(filename):
+    if not _VARIANT_RE.fullmatch(filename):
+        abort(404)
+    response = send_from_directory(product_image_folder(), filename, max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def get_header_context():
+    # Пользователь и число товаров в корзине для шапки: один запрос на страницу,
+    # количество дополнительно кэшируется по user_id до изменения корзины
+    if 'header_context' in g:
+        return g.header_context
+
+    context = {'current_user': None, 'cart_items_count': 0}
+    user_id = session.get('user_id')
+    if user_id is not None:
+        db = get_session()
+        count = cart_count_cache.get(user_id)
+        if count is None:
+            row = db.query(User, func.coalesce(func.sum(CartItem.quantity), 0)).outerjoin(
+                Cart, Cart.user_id == User.id
+            ).outerjoin(
+                CartItem, CartItem.cart_id == Cart.id
+            ).filter(User.id == user_id).group_by(User.id).first()
+            if row:
+                context['current_user'], count = row[0], int(row[1])
+                cart_count_cache.set(user_id, count)
+        else:
+            context['current_user'] = db.query(User).get(user_id)
+        context['cart_items_count'] = count or 0
 
+    g.header_context = context
+    return context
 
-def validate_promo(code, user_id):
-    db = next(get_db())
-    try:
-        promo = db.query(PromoCode).filter_by(code=code.upper()).first()
-        if not promo or not promo.is_active:
-            return None, "Недействительный промокод"
-
-        if promo.end_date and promo.end_date < datetime.utcnow():
-            return None, "Промокод истек"
-
-        if promo.activations_count >= promo.max_activations:
-            return None, "Лимит активаций исчерпан"
-
-        if not promo.is_reusable:
-            existing = db.query(Order).filter(
-                Order.user_id == user_id,
-                Order.promo_code == promo.code
-            ).first()
-            if existing:
-                return None, "Вы уже использовали этот промокод"
-        cart_total = calculate_cart_total(user_id)
-        if cart_total < 1000:
-            return None, "Минимальная сумма заказа для промокода 1000 руб."
-
-        return promo, ""
-    finally:
-        db.close()
-        return promo, ""
+
+def invalidate_cart_count(user_id=None):
+    if user_id is None:
+        cart_count_cache.clear()
+    else:
+        cart_count_cache.invalidate(user_id)
+    g.pop('header_context', None)
+
+
+@app.context_processor
+def inject_header():
+    return get_header_context()
 
 
 @app.route('/admin/promo/delete/<int:promo_id>', methods=['DELETE'])
@@ -143,7 +225,7 @@ def admin_delete_promo(promo_id):
     if not is_admin():
         return jsonify({'error': 'Доступ запрещён'}), 403
 
-    db = next(get_db())
+    db = get_session()
     try:
         promo = db.query(PromoCode).get(promo_id)
         if not promo:
@@ -151,12 +233,11 @@ def admin_delete_promo(promo_id):
 
         db.delete(promo)
         db.commit()
+        invalidate_promos(promo.code)
         return jsonify({'success': True})
     except Exception as e:
         db.rollback()
         return jsonify({'error': str(e)}), 500
-    finally:
-        db.close()
 
 
 @app.route('/api/apply_promo', methods=['POST'])
@@ -165,49 +246,33 @@ def apply_promo():
     if 'user_id' not in session:
         return jsonify({'error': 'Требуется авторизация'}), 401
 
-    db = next(get_db())
+    db = get_session()
     try:
         data = request.get_json()
         code = data.get('code', '').strip().upper()
         user_id = session['user_id']
 
-        cart = db.query(Cart).options(
-            joinedload(Cart.items).joinedload(CartItem.product)
-        ).filter_by(user_id=user_id).first()
-
-        if not cart or not cart.items:
+        totals = get_cart_totals(db, user_id)
+        if not totals.items_count:
             return jsonify({'error': 'Корзина пуста'}), 400
 
-        cart_total = sum(
-            Decimal(str(item.product.price)) * item.quantity
-            for item in cart.items
-        )
-
-        promo = db.query(PromoCode).filter_by(code=code).first()
-        if not promo or not promo.is_active:
-            return jsonify({'error': 'Недействительный промокод'}), 400
-
-        if promo.end_date and promo.end_date < datetime.utcnow():
-            return jsonify({'error': 'Промокод истек'}), 400
-
-        if promo.activations_count >= promo.max_activations:
-            return jsonify({'error': 'Лимит активаций исчерпан'}), 400
+        cart_total = totals.subtotal
 
-        discount = Decimal(str(promo.discount)) / Decimal(100)
-        new_total = cart_total * (Decimal(1) - discount)
+        try:
+            promo = evaluate_promo(db, code, user_id, cart_total)
+        except PromoError as e:
+            return jsonify({'error': e.message}), 400
 
         return jsonify({
             'code': promo.code,
             'discount': float(promo.discount),
             'original_total': float(cart_total),
-            'new_total': float(new_total.quantize(Decimal('0.01'))),
+            'new_total': float(apply_discount(cart_total, promo)),
             'remaining_uses': promo.max_activations - promo.activations_count
         })
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        db.close()
 
 
 @app.route('/admin/promo')
@@ -216,15 +281,13 @@ def admin_promo_list():
         flash('Доступ запрещён', 'danger')
         return redirect(url_for('home'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         promos = db.query(PromoCode).order_by(PromoCode.id.desc()).all()
         return render_template('admin/promo_list.html', promos=promos)
     except Exception as e:
         flash(f'Ошибка загрузки промокодов: {str(e)}', 'danger')
         return redirect(url_for('home'))
-    finally:
-        db.close()
 
 
 @app.route('/admin/promo/create', methods=['GET', 'POST'])
@@ -233,13 +296,12 @@ def admin_create_promo():
         flash('Доступ запрещён', 'danger')
         return redirect(url_for('home'))
 
-    db = next(get_db())
+    db = get_session()
 
     if request.method == 'POST':
         try:
-            end_date = datetime.fromisoformat(request.form['end_date']) if request.form.get('end_date') else None
-            if end_date:
-                end_date = end_date.astimezone(pytz.timezone('Europe/Moscow'))
+            # Срок вводится по местному времени, хранится в UTC
+            end_date = to_utc(datetime.fromisoformat(request.form['end_date'])) if request.form.get('end_date') else None
 
             promo_data = {
                 'code': request.form['code'].strip().upper(),
@@ -253,6 +315,7 @@ def admin_create_promo():
             new_promo = PromoCode(**promo_data)
             db.add(new_promo)
             db.commit()
+            invalidate_promos(new_promo.code)
 
             flash('Промокод успешно создан', 'success')
             return redirect(url_for('admin_promo_list'))
@@ -261,8 +324,6 @@ def admin_create_promo():
             db.rollback()
             flash(f'Ошибка создания промокода: {str(e)}', 'danger')
             return redirect(url_for('admin_promo_list'))
-        finally:
-            db.close()
 
     return render_template('admin/promo_form.html')
 
@@ -273,7 +334,7 @@ def admin_edit_promo(promo_id):
         flash('Доступ запрещён', 'danger')
         return redirect(url_for('home'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         promo = db.query(PromoCode).get(promo_id)
         if not promo:
@@ -281,14 +342,16 @@ def admin_edit_promo(promo_id):
             return redirect(url_for('admin_promo_list'))
 
         if request.method == 'POST':
+            old_code = promo.code
             promo.code = request.form['code'].strip().upper()
             promo.discount = float(request.form['discount'])
             promo.max_activations = int(request.form['max_activations'])
-            promo.end_date = datetime.fromisoformat(request.form['end_date']) if request.form['end_date'] else None
+            promo.end_date = to_utc(datetime.fromisoformat(request.form['end_date'])) if request.form['end_date'] else None
             promo.is_active = 'is_active' in request.form
             promo.is_reusable = 'is_reusable' in request.form
 
             db.commit()
+            invalidate_promos(old_code, promo.code)
             flash('Промокод успешно обновлён', 'success')
             return redirect(url_for('admin_promo_list'))
 
@@ -302,15 +365,243 @@ def admin_edit_promo(promo_id):
         db.rollback()
         flash(f'Ошибка обновления промокода: {str(e)}', 'danger')
         return redirect(url_for('admin_edit_promo', promo_id=promo_id))
-    finally:
-        db.close()
+
+
+CATALOG_PREVIEW_SIZE = 6
+CATALOG_PAGE_SIZE = 24
+
+
+# Отрендеренные фрагменты каталога не зависят от пользователя, поэтому
+# общие для всех посетителей. Ключи содержат версию каталога, которую
+# увеличивают триггеры базы при изменении товаров, категорий и остатков;
+# сбрасывать кэш после изменений не нужно, старые записи вытеснит LRU/ttl.
+def catalog_version():
+    if 'catalog_version' not in g:
+        g.catalog_version = get_catalog_version(get_session())
+    return g.catalog_version
+
+
+def render_catalog_fragment(template_name, cache_key, build_context):
+    # Версия в ключе делает кэш корректным и между процессами: после изменения
+    # каталога в другом воркере старые фрагменты просто перестают запрашиваться
+    cache_key = (catalog_version(), cache_key)
+    html = catalog_cache.get(cache_key)
+    if html is None:
+        html = app.jinja_env.get_template(template_name).render(**build_context())
+        catalog_cache.set(cache_key, html)
+    return Markup(html)
+
+
+def get_catalog_categories():
+    cache_key = (catalog_version(), 'categories')
+    categories = catalog_cache.get(cache_key)
+    if categories is None:
+        db = get_session()
+        categories = [
+            {'id': category_id, 'name': name, 'product_count': product_count}
+            for category_id, name, product_count in db.query(
+                Category.id, Category.name, Category.product_count
+            ).order_by(Category.id)
+        ]
+        catalog_cache.set(cache_key, categories)
+    return categories
+
+
+# Меняется при выкладке новой версии шаблонов, чтобы браузеры не получали 304
+# на страницы со старой разметкой
+CACHE_BUILD_ID = os.environ.get('CACHE_BUILD_ID', '1')
+SUGGEST_MAX_AGE = 60
+
+
+def catalog_page_etag():
+    # Страница каталога зависит от версии каталога и от шапки: пользователь,
+    # права администратора и число товаров в корзине. Страницы с
+    # flash-сообщениями показываются один раз и не кэшируются.
+    if session.get('_flashes'):
+        return None
+    header = get_header_context()
+    user = header['current_user']
+    return '-'.join(str(part) for part in (
+        CACHE_BUILD_ID, catalog_version(), user.id if user else 0,
+        int(bool(user and user.is_admin)), header['cart_items_count']
+    ))
+
+
+def conditional_catalog_page(view):
+    # Повторный запрос с совпадающим If-None-Match получает 304 без рендеринга
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        etag = catalog_page_etag()
+        if etag and request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        if etag:
+            response.set_etag(etag, weak=True)
+        response.cache_control.no_cache = True
+        if 'user_id' in session:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.vary.add('Cookie')
+        return response
+
+    return decorated_function
+
+
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+_asset_versions = {}
+
+
+def asset_url(filename):
+    # URL статического файла с отпечатком содержимого (?v=...): файл с
+    # отпечатком кэшируется навсегда, а изменённый файл получает новый URL
+    version = _asset_versions.get(filename)
+    if version is None or app.debug:
+        with open(os.path.join(app.static_folder, filename), 'rb') as file:
+            version = _asset_versions[filename] = hashlib.sha1(file.read()).hexdigest()[:12]
+    return url_for('static', filename=filename, v=version)
+
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+
+@app.after_request
+def apply_cache_policy(response):
+    # Политика по умолчанию для HTML без своих заголовков: страницы
+    # пользователя не сохраняются, остальные всегда перепроверяются
+    if response.mimetype == 'text/html' and 'Cache-Control' not in response.headers:
+        if 'user_id' in session:
+            response.cache_control.private = True
+            response.cache_control.no_store = True
+        else:
+            response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    elif request.endpoint == 'static' and request.args.get('v') and response.status_code in (200, 304):
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
 
 
 @app.route('/')
+@conditional_catalog_page
 def home():
-    db = next(get_db())
-    categories = db.query(Category).options(joinedload(Category.products)).all()
-    return render_template('main.html', categories=categories)
+    categories = get_catalog_categories()
+
+    def build_context():
+        db = get_session()
+        # Первые товары каждой категории отдельным LIMIT по индексу
+        # ix_products_category_id, а не нумерацией всех товаров каталога
+        preview = aliased(Product)
+        preview_ids = select(preview.id).where(preview.category_id == Category.id).order_by(
+            preview.id
+        ).limit(CATALOG_PREVIEW_SIZE).correlate(Category)
+        products = db.query(Product).select_from(Category).join(
+            Product, Product.id.in_(preview_ids)
+        ).options(joinedload(Product.category)).order_by(Product.id).all()
+
+        products_by_category = {}
+        for product in products:
+            products_by_category.setdefault(product.category_id, []).append(product)
+
+        return {
+            'categories': categories,
+            'products_by_category': products_by_category,
+            'product_counts': {category['id']: category['product_count'] for category in categories}
+        }
+
+    catalog_html = render_catalog_fragment('catalog.html', 'home', build_context)
+    return render_template('main.html', categories=categories, catalog_html=catalog_html)
+
+
+@app.route('/category/<int:category_id>')
+@conditional_catalog_page
+def category_products(category_id):
+    page = max(request.args.get('page', 1, type=int), 1)
+    categories = get_catalog_categories()
+    category = next((c for c in categories if c['id'] == category_id), None)
+    if category is None:
+        abort(404)
+
+    def build_context():
+        db = get_session()
+        total = category['product_count']
+        products = db.query(Product).options(joinedload(Product.category)).filter(
+            Product.category_id == category_id
+        ).order_by(Product.id).offset((page - 1) * CATALOG_PAGE_SIZE).limit(CATALOG_PAGE_SIZE).all()
+        return {
+            'category': category,
+            'products': products,
+            'page': page,
+            'pages': max((total + CATALOG_PAGE_SIZE - 1) // CATALOG_PAGE_SIZE, 1)
+        }
+
+    catalog_html = render_catalog_fragment(
+        'category_products.html', ('category', category_id, page), build_context
+    )
+    return render_template('main.html', categories=categories, catalog_html=catalog_html)
+
+
+SEARCH_PAGE_SIZE = 24
+SUGGEST_LIMIT = 8
+
+
+@app.route('/search')
+@conditional_catalog_page
+def search():
+    query = request.args.get('q', '').strip()
+    category_id = request.args.get('category', type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    db = get_session()
+    results, total = search_products(
+        db, query,
+        category_id=category_id,
+        limit=SEARCH_PAGE_SIZE,
+        offset=(page - 1) * SEARCH_PAGE_SIZE
+    )
+    return render_template(
+        'search_results.html',
+        query=query,
+        results=results,
+        total=total,
+        category_id=category_id,
+        categories=get_catalog_categories(),
+        page=page,
+        pages=max((total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE, 1)
+    )
+
+
+@app.route('/api/search/suggest')
+def search_suggest():
+    etag = hashlib.sha1(f'{catalog_version()}?{request.query_string.decode()}'.encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = search_suggest_response()
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = SUGGEST_MAX_AGE
+    return response
+
+
+def search_suggest_response():
+    db = get_session()
+    results, _ = search_products(
+        db, request.args.get('q', ''),
+        category_id=request.args.get('category', type=int),
+        limit=SUGGEST_LIMIT,
+        with_total=False,
+        names_only=True
+    )
+    return jsonify([
+        {'id': product.id, 'name': product.name, 'price': float(product.price)}
+        for product in results
+    ])
 
 
 @app.route('/update_cart/<int:item_id>', methods=['POST'])
@@ -318,38 +609,25 @@ def update_cart(item_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         action = request.form.get('action')
-        item = db.query(CartItem).get(item_id)
-
-        if not item or item.cart.user_id != session['user_id']:
-            flash('Элемент не найден', 'danger')
-            return redirect(url_for('view_cart'))
-
-        product = db.query(Product).get(item.product_id)
-
-        if action == 'increment':
-            if product.stock_quantity > item.quantity:
-                item.quantity += 1
-            else:
-                flash(f'Максимальное количество товара {product.name} - {product.stock_quantity}', 'warning')
-        elif action == 'decrement':
-            if item.quantity > 1:
-                item.quantity -= 1
-            else:
-                db.delete(item)
-        else:
+        if action not in ('increment', 'decrement'):
             flash('Некорректное действие', 'danger')
+            return redirect(url_for('view_cart'))
 
+        # Позиция ищется в корзине пользователя внутри set_item_quantity
+        set_item_quantity(db, session['user_id'], item_id, delta=1 if action == 'increment' else -1)
         db.commit()
+        invalidate_cart_count(session['user_id'])
         flash('Корзина обновлена', 'success')
 
+    except CartError as e:
+        db.rollback()
+        flash(e.message, 'danger' if e.reason == 'not_found' else 'warning')
     except Exception as e:
         db.rollback()
         flash(f'Ошибка: {str(e)}', 'danger')
-    finally:
-        db.close()
 
     return redirect(url_for('view_cart'))
 
@@ -360,129 +638,72 @@ def delivery():
         flash('Требуется авторизация', 'danger')
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         user = db.query(User).get(session['user_id'])
 
         if not user.phone or not re.match(r'^\+7\d{10}$', user.phone):
+            if request.method == 'POST':
+                metrics.record_checkout(failure='invalid_phone')
             flash('Проверьте номер телефона в профиле', 'danger')
             return redirect(url_for('profile'))
 
         if request.method == 'GET':
-            cart = db.query(Cart).options(
-                joinedload(Cart.items).joinedload(CartItem.product)
-            ).filter_by(user_id=user.id).first()
-
-            if not cart or not cart.items:
+            totals = get_cart_totals(db, user.id)
+            if not totals.items_count:
                 flash('Корзина пуста', 'danger')
                 return redirect(url_for('view_cart'))
 
-            total = sum(
-                Decimal(str(item.product.price)) * item.quantity
-                for item in cart.items
-            )
-
             return render_template('delivery.html',
-                                   cart_items=cart.items,
-                                   total=total,
+                                   cart_items=get_cart_lines(db, totals.cart_id),
+                                   total=totals.subtotal,
                                    user=user)
 
         elif request.method == 'POST':
             promo_code = request.form.get('promo_code', '').strip().upper()
-            cart = db.query(Cart).options(
-                joinedload(Cart.items).joinedload(CartItem.product)
-            ).filter_by(user_id=user.id).first()
+            address = {
+                'country': request.form['country'],
+                'city': request.form['city'],
+                'street': request.form['street'],
+                'house': request.form['house'],
+                'apartment': request.form.get('apartment', ''),
+                'additional_info': request.form.get('additional_info', '')
+            }
 
-            if not cart or not cart.items:
-                flash('Корзина пуста', 'danger')
+            try:
+                new_order, warnings = place_order(db, user, address, promo_code)
+            except CheckoutError as e:
+                db.rollback()
+                metrics.record_checkout(failure=e.reason)
+                flash(e.message, 'danger')
                 return redirect(url_for('view_cart'))
 
-            total = Decimal('0')
-            for item in cart.items:
-                product = db.query(Product).get(item.product_id)
-                if product.stock_quantity < item.quantity:
-                    flash(f'Недостаточно товара "{product.name}". Доступно: {product.stock_quantity}', 'danger')
-                    return redirect(url_for('view_cart'))
-                total += Decimal(str(product.price)) * item.quantity
-
-            promo = None
-            total_with_discount = total
-
-            if promo_code:
-                promo = db.query(PromoCode).filter_by(code=promo_code).first()
-
-                if promo and promo.is_active:
-                    if promo.end_date and promo.end_date < datetime.utcnow():
-                        flash('Срок действия промокода истек', 'danger')
-                    elif promo.activations_count >= promo.max_activations:
-                        flash('Лимит активаций промокода исчерпан', 'danger')
-                    else:
-                        discount = Decimal(str(promo.discount)) / Decimal(100)
-                        total_with_discount = total * (Decimal('1') - discount)
-
-                        promo.activations_count += 1
-                        if promo.activations_count >= promo.max_activations:
-                            promo.is_active = False
-                        db.commit()
-
-            new_order = Order(
-                user_id=user.id,
-                total_amount=total_with_discount.quantize(Decimal('0.01')),
-                status='Ожидает оплаты',
-                promo_code=promo.code if promo else None,
-                created_at=datetime.utcnow()
-            )
-            db.add(new_order)
-            db.flush()
-
-            for item in cart.items:
-                product = db.query(Product).get(item.product_id)
-                product.stock_quantity -= item.quantity
-
-                order_item = OrderItem(
-                    order_id=new_order.id,
-                    product_id=product.id,
-                    quantity=item.quantity,
-                    price_at_purchase=product.price
-                )
-                db.add(order_item)
-
-            delivery_address = DeliveryAddress(
-                order_id=new_order.id,
-                country=request.form['country'],
-                city=request.form['city'],
-                street=request.form['street'],
-                house=request.form['house'],
-                apartment=request.form.get('apartment', ''),
-                phone=user.phone,
-                additional_info=request.form.get('additional_info', '')
-            )
-            db.add(delivery_address)
-
-            db.query(CartItem).filter_by(cart_id=cart.id).delete()
             db.commit()
+            metrics.record_checkout(new_order, warnings)
+            invalidate_cart_count(user.id)
 
+            for message, reason in warnings:
+                flash(message, 'danger')
             flash(f'Заказ №{new_order.id} успешно оформлен!', 'success')
             return redirect(url_for('orders'))
 
     except IntegrityError as e:
         db.rollback()
+        metrics.record_checkout(failure='integrity_error')
         flash('Ошибка при создании заказа', 'danger')
         return redirect(url_for('view_cart'))
 
     except Exception as e:
         db.rollback()
+        metrics.record_checkout(failure='error')
         flash(f'Критическая ошибка: {str(e)}', 'danger')
         return redirect(url_for('view_cart'))
 
-    finally:
-        db.close()
-
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
-        db = next(get_db())
+        db = get_session()
         try:
             phone = format_phone_number(request.form['phone'])
             if not phone:
@@ -512,23 +733,18 @@ def register():
         except Exception as e:
             db.rollback()
             flash(f'Ошибка: {str(e)}', 'danger')
-        finally:
-            db.close()
     return render_template('registration.html')
 
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        db = next(get_db())
-        try:
-            user = db.query(User).filter_by(email=request.form['email']).first()
-            if user and user.password == request.form['password']:
-                session['user_id'] = user.id
-                return redirect(url_for('profile'))
-            flash('Неверный email или пароль', 'danger')
-        finally:
-            db.close()
+        db = get_session()
+        user = db.query(User).filter_by(email=request.form['email']).first()
+        if user and user.password == request.form['password']:
+            session['user_id'] = user.id
+            return redirect(url_for('profile'))
+        flash('Неверный email или пароль', 'danger')
     return render_template('auth.html')
 
 
@@ -537,28 +753,27 @@ def profile():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     user = db.query(User).get(session['user_id'])
 
     if request.method == 'POST':
         try:
-            user.name = request.form['name']
-            user.surname = request.form['surname']
-            user.email = request.form['email']
-
             new_phone = format_phone_number(request.form['phone'])
             if not new_phone:
                 flash('Неверный формат телефона. Используйте российский номер', 'danger')
                 return redirect(url_for('profile'))
 
-            user.phone = new_phone
-
             if request.form['new_password']:
                 if request.form['new_password'] != request.form['confirm_password']:
                     flash('Пароли не совпадают', 'danger')
                     return redirect(url_for('profile'))
                 user.password = request.form['new_password']
 
+            user.name = request.form['name']
+            user.surname = request.form['surname']
+            user.email = request.form['email']
+            user.phone = new_phone
+
             db.commit()
             flash('Профиль успешно обновлен', 'success')
             return redirect(url_for('profile'))
@@ -584,31 +799,20 @@ def view_cart():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
-        cart = db.query(Cart).options(
-            joinedload(Cart.items).joinedload(CartItem.product)
-        ).filter_by(user_id=session['user_id']).first()
-
-        if not cart or not cart.items:
+        totals = get_cart_totals(db, session['user_id'])
+        if not totals.items_count:
             return render_template('cart.html', cart_items=[], total=Decimal('0'))
 
-        total = Decimal('0')
-        for item in cart.items:
-            price = Decimal(str(item.product.price))
-            quantity = Decimal(str(item.quantity))
-            total += price * quantity
-
         return render_template(
             'cart.html',
-            cart_items=cart.items,
-            total=total.quantize(Decimal('0.01')))
+            cart_items=get_cart_lines(db, totals.cart_id),
+            total=totals.subtotal)
 
     except Exception as e:
         flash(f'Ошибка загрузки корзины: {str(e)}', 'danger')
         return redirect(url_for('home'))
-    finally:
-        db.close()
 
 
 @app.route('/add_to_cart/<int:product_id>', methods=['POST'])
@@ -616,44 +820,45 @@ def add_to_cart(product_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
-        product = db.query(Product).get(product_id)
-        if not product or product.stock_quantity < 1:
-            flash('Товар недоступен', 'danger')
-            return redirect(request.referrer)
-
-        cart = db.query(Cart).filter_by(user_id=session['user_id']).first()
-        if not cart:
-            cart = Cart(user_id=session['user_id'])
-            db.add(cart)
-            db.commit()
+        add_item(db, session['user_id'], product_id)
+        db.commit()
+        invalidate_cart_count(session['user_id'])
+        flash('Товар добавлен в корзину', 'success')
+    except CartError as e:
+        db.rollback()
+        flash(e.message, 'danger')
+    except Exception as e:
+        db.rollback()
+        flash(f'Ошибка: {str(e)}', 'danger')
 
-        cart_item = db.query(CartItem).filter_by(
-            cart_id=cart.id,
-            product_id=product_id
-        ).first()
+    return redirect(request.referrer or url_for('home'))
 
-        if cart_item:
-            cart_item.quantity += 1
-        else:
-            cart_item = CartItem(
-                cart_id=cart.id,
-                product_id=product_id,
-                quantity=1
-            )
-            db.add(cart_item)
 
-        db.commit()
-        flash('Товар добавлен в корзину', 'success')
+@app.route('/api/cart/add/<int:product_id>', methods=['POST'])
+def api_add_to_cart(product_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Требуется авторизация'}), 401
 
+    db = get_session()
+    try:
+        quantity = add_item(db, session['user_id'], product_id)
+        db.commit()
+    except CartError as e:
+        db.rollback()
+        return jsonify({'error': e.message}), 409
     except Exception as e:
         db.rollback()
-        flash(f'Ошибка: {str(e)}', 'danger')
-    finally:
-        db.close()
+        return jsonify({'error': str(e)}), 500
 
-    return redirect(request.referrer)
+    invalidate_cart_count(session['user_id'])
+    return jsonify({
+        'success': True,
+        'product_id': product_id,
+        'quantity': quantity,
+        'cart_items_count': get_header_context()['cart_items_count']
+    })
 
 
 @app.route('/remove_from_cart/<int:item_id>', methods=['POST'])
@@ -661,37 +866,82 @@ def remove_from_cart(item_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
-        item = db.query(CartItem).get(item_id)
-        if item and item.cart.user_id == session['user_id']:
-            item.product.stock_quantity += item.quantity
-            db.delete(item)
-            db.commit()
-            flash('Товар удалён из корзины', 'success')
-        else:
-            flash('Элемент не найден', 'danger')
+        set_item_quantity(db, session['user_id'], item_id, 0)
+        db.commit()
+        invalidate_cart_count(session['user_id'])
+        flash('Товар удалён из корзины', 'success')
+    except CartError as e:
+        db.rollback()
+        flash(e.message, 'danger')
     except Exception as e:
         db.rollback()
         flash(f'Ошибка: {str(e)}', 'danger')
-    finally:
-        db.close()
 
     return redirect(url_for('view_cart'))
 
 
+ORDERS_PAGE_SIZE = 20
+
+
+def encode_order_cursor(order):
+    return f'{order.created_at.isoformat()}_{order.id}'
+
+
+def decode_order_cursor(cursor):
+    try:
+        created_at, order_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (AttributeError, ValueError):
+        return None
+
+
 @app.route('/orders')
 def orders():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
-    orders = db.query(Order).options(
-        joinedload(Order.items).joinedload(OrderItem.product),
-        joinedload(Order.delivery_address)
-    ).filter_by(user_id=session['user_id']).all()
+    db = get_session()
+    query = db.query(
+        Order.id, Order.created_at, Order.status, Order.total_amount,
+        func.coalesce(func.sum(OrderItem.quantity), 0).label('items_count')
+    ).outerjoin(
+        OrderItem, OrderItem.order_id == Order.id
+    ).filter(Order.user_id == session['user_id'])
+
+    # Keyset-пагинация: следующая страница начинается строго после последнего
+    # показанного заказа по (created_at, id), без OFFSET
+    cursor = decode_order_cursor(request.args.get('cursor'))
+    if cursor:
+        query = query.filter(tuple_(Order.created_at, Order.id) < tuple_(*cursor))
+
+    rows = query.group_by(Order.id).order_by(
+        Order.created_at.desc(), Order.id.desc()
+    ).limit(ORDERS_PAGE_SIZE + 1).all()
+
+    next_cursor = None
+    if len(rows) > ORDERS_PAGE_SIZE:
+        rows = rows[:ORDERS_PAGE_SIZE]
+        next_cursor = encode_order_cursor(rows[-1])
+
+    return render_template('orders.html', orders=rows, next_cursor=next_cursor, is_first_page=cursor is None)
+
+
+@app.route('/orders/<int:order_id>')
+def order_details(order_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    db = get_session()
+    order = db.query(Order).options(
+        selectinload(Order.items).joinedload(OrderItem.product),
+        selectinload(Order.delivery_address)
+    ).filter_by(id=order_id, user_id=session['user_id']).first()
+    if not order:
+        abort(404)
 
-    return render_template('orders.html', orders=orders)
+    return render_template('order_details.html', order=order)
 
 
 @app.route('/admin')
@@ -700,34 +950,152 @@ def admin_panel():
         flash('Требуется авторизация', 'danger')
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         user = db.query(User).get(session['user_id'])
         if not user.is_admin:
             flash('Доступ запрещён', 'danger')
             return redirect(url_for('home'))
 
-        stats = {
-            'users': db.query(User).count(),
-            'products': db.query(Product).count(),
-            'orders': db.query(Order).count(),
-            'categories': db.query(Category).count()
-        }
+        stats = db.query(
+            select(func.count(User.id)).scalar_subquery().label('users'),
+            select(func.count(Product.id)).scalar_subquery().label('products'),
+            select(func.count(Order.id)).scalar_subquery().label('orders'),
+            select(func.count(Category.id)).scalar_subquery().label('categories')
+        ).one()._asdict()
 
-        products = db.query(Product).options(joinedload(Product.category)).all()
-        categories = db.query(Category).all()
+        categories = db.query(Category).order_by(Category.name).all()
 
         return render_template(
             'admin.html',
             stats=stats,
-            products=products,
-            categories=categories
+            sales=analytics.daily_sales(db),
+            categories=categories,
+            page_size=ADMIN_PAGE_SIZE
         )
     except Exception as e:
         flash(f'Ошибка: {str(e)}', 'danger')
         return redirect(url_for('home'))
-    finally:
-        db.close()
+
+
+ADMIN_PAGE_SIZE = 25
+ADMIN_MAX_PAGE_SIZE = 100
+LOW_STOCK_THRESHOLD = 5
+ADMIN_PRODUCT_SORTS = {
+    'id': Product.id,
+    'name': Product.name,
+    'price': Product.price,
+    'stock': Product.stock_quantity
+}
+
+
+@app.route('/admin/_profile')
+@admin_required
+def admin_profile():
+    enabled = app.config['DB_PROFILE']
+    snapshot = profiler.stats.snapshot(limit=request.args.get('limit', 50, type=int))
+    if request.args.get('format') == 'json':
+        return jsonify({'enabled': enabled, **snapshot})
+    return render_template('admin/profile.html', enabled=enabled, profile=snapshot)
+
+
+@app.route('/admin/_profile/reset', methods=['POST'])
+@admin_required
+def admin_profile_reset():
+    profiler.stats.reset()
+    return redirect(url_for('admin_profile'))
+
+
+ANALYTICS_MAX_DAYS = 366
+
+
+@app.route('/admin/api/analytics/daily')
+def admin_analytics_daily():
+    if not is_admin():
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    days = min(max(request.args.get('days', 30, type=int), 1), ANALYTICS_MAX_DAYS)
+    end = request.args.get('to', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date())
+    return jsonify(analytics.daily_sales(get_session(), days=days, end=end))
+
+
+@app.route('/admin/api/analytics/products')
+def admin_analytics_products():
+    if not is_admin():
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    limit = min(max(request.args.get('limit', 20, type=int), 1), ADMIN_MAX_PAGE_SIZE)
+    sort = request.args.get('sort', 'revenue')
+    return jsonify({'products': analytics.top_products(get_session(), limit=limit, sort=sort)})
+
+
+@app.route('/admin/api/analytics/categories')
+def admin_analytics_categories():
+    if not is_admin():
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    return jsonify({'categories': analytics.category_sales(get_session())})
+
+
+@app.route('/admin/api/analytics/promos')
+def admin_analytics_promos():
+    if not is_admin():
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    return jsonify({'promos': analytics.promo_usage(get_session())})
+
+
+@app.route('/admin/api/products')
+def admin_products_api():
+    if not is_admin():
+        return jsonify({'error': 'Доступ запрещён'}), 403
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', ADMIN_PAGE_SIZE, type=int), 1), ADMIN_MAX_PAGE_SIZE)
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort_column = ADMIN_PRODUCT_SORTS.get(sort.lstrip('-'), Product.id)
+
+    db = get_session()
+    query = db.query(Product)
+
+    category_id = request.args.get('category_id', type=int)
+    if category_id:
+        query = query.filter(Product.category_id == category_id)
+
+    stock = request.args.get('stock')
+    if stock == 'in':
+        query = query.filter(Product.stock_quantity > 0)
+    elif stock == 'out':
+        query = query.filter(or_(Product.stock_quantity <= 0, Product.stock_quantity.is_(None)))
+    elif stock == 'low':
+        query = query.filter(Product.stock_quantity > 0, Product.stock_quantity <= LOW_STOCK_THRESHOLD)
+
+    # Префикс по диапазону, а не через LIKE, чтобы работал индекс по name
+    prefix = request.args.get('q', '').strip()
+    if prefix:
+        query = query.filter(Product.name >= prefix, Product.name < prefix + '\U0010ffff')
+
+    total = query.with_entities(func.count(Product.id)).scalar()
+    products = query.options(joinedload(Product.category)).order_by(
+        sort_column.desc() if descending else sort_column,
+        Product.id.desc() if descending else Product.id
+    ).offset((page - 1) * per_page).limit(per_page).all()
+
+    return jsonify({
+        'items': [
+            {
+                'id': product.id,
+                'name': product.name,
+                'description': product.description or '',
+                'price': float(product.price),
+                'stock_quantity': product.stock_quantity,
+                'category': product.category.name if product.category else None,
+                'edit_url': url_for('edit_product', product_id=product.id),
+                'delete_url': url_for('delete_product', product_id=product.id)
+            }
+            for product in products
+        ],
+        'total': total,
+        'page': page,
+        'pages': max((total + per_page - 1) // per_page, 1)
+    })
 
 
 @app.route('/admin/add_product', methods=['POST'])
@@ -736,39 +1104,69 @@ def add_product():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         user = db.query(User).get(session['user_id'])
         if not user.is_admin:
             return render_template('access_denied.html')
 
         new_product = Product(
+            sku=request.form.get('sku', '').strip() or None,
             name=request.form['name'],
             description=request.form['description'],
             price=float(request.form['price']),
             stock_quantity=int(request.form['stock_quantity']),
             category_id=int(request.form['category_id']),
-            image_url=request.form.get('image_url')
+            image_url=store_uploaded_image() or request.form.get('image_url') or None
         )
 
         db.add(new_product)
+        db.flush()
+        if not new_product.sku:
+            new_product.sku = f'P{new_product.id:06d}'
         db.commit()
         flash('Товар успешно добавлен', 'success')
     except Exception as e:
         db.rollback()
         flash(f'Ошибка: {str(e)}', 'danger')
-    finally:
-        db.close()
 
     return redirect(url_for('admin_panel'))
 
 
+@app.route('/admin/import', methods=['POST'])
+def admin_import_products():
+    if not is_admin():
+        return jsonify({'error': 'Доступ запрещён'}), 403
+
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'error': 'Файл не выбран'}), 400
+
+    fmt = request.form.get('format') or detect_format(upload.filename)
+    report = import_products(get_session(), read_rows(upload.stream, fmt))
+    return jsonify(report)
+
+
+@app.route('/admin/export')
+def admin_export_products():
+    if not is_admin():
+        abort(403)
+
+    fmt = 'jsonl' if request.args.get('format') == 'jsonl' else 'csv'
+    mimetype = 'application/x-ndjson' if fmt == 'jsonl' else 'text/csv'
+    return Response(
+        stream_with_context(iter_export(get_session(), fmt)),
+        mimetype=f'{mimetype}; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename=products.{fmt}'}
+    )
+
+
 @app.route('/admin/add_category', methods=['POST'])
 def add_category():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         user = db.query(User).get(session['user_id'])
         if not user.is_admin:
@@ -784,8 +1182,6 @@ def add_category():
     except Exception as e:
         db.rollback()
         flash(f'Ошибка: {str(e)}', 'danger')
-    finally:
-        db.close()
 
     return redirect(url_for('admin_panel'))
 
@@ -795,33 +1191,23 @@ def delete_product(product_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         user = db.query(User).get(session['user_id'])
         if not user.is_admin:
             return render_template('access_denied.html')
 
-        product = db.query(Product).get(product_id)
+        product = db.query(Product.id, Product.image_url).filter(Product.id == product_id).first()
         if product:
-            db.query(CartItem).filter_by(product_id=product_id).delete()
-            db.query(OrderItem).filter_by(product_id=product_id).delete()
-
-            if product.image_url and product.image_url.startswith('/static'):
-                try:
-                    os.remove(os.path.join(app.root_path, product.image_url[1:]))
-                except Exception as e:
-                    print(f"Error deleting image: {str(e)}")
-
-            db.delete(product)
+            delete_products(db, [product])
             db.commit()
+            invalidate_cart_count()
             flash('Товар и все связанные данные удалены', 'success')
         return redirect(url_for('admin_panel'))
     except Exception as e:
         db.rollback()
         flash(f'Ошибка: {str(e)}', 'danger')
         return redirect(url_for('admin_panel'))
-    finally:
-        db.close()
 
 
 @app.route('/payment')
@@ -837,7 +1223,7 @@ def delete_category(category_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         user = db.query(User).get(session['user_id'])
         if not user.is_admin:
@@ -845,17 +1231,18 @@ def delete_category(category_id):
 
         category = db.query(Category).get(category_id)
         if category:
-            db.query(Product).filter_by(category_id=category_id).delete()
+            products = db.query(Product.id, Product.image_url).filter(Product.category_id == category_id).all()
+            if products:
+                delete_products(db, products)
             db.delete(category)
             db.commit()
+            invalidate_cart_count()
             flash('Категория и связанные товары удалены', 'success')
         return redirect(url_for('admin_panel'))
     except Exception as e:
         db.rollback()
         flash(f'Ошибка удаления: {str(e)}', 'danger')
         return redirect(url_for('admin_panel'))
-    finally:
-        db.close()
 
 
 @app.route('/logout')
@@ -870,7 +1257,7 @@ def edit_product(product_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = next(get_db())
+    db = get_session()
     try:
         user = db.query(User).get(session['user_id'])
         if not user.is_admin:
@@ -881,13 +1268,20 @@ def edit_product(product_id):
         categories = db.query(Category).all()
 
         if request.method == 'POST':
+            product.sku = request.form.get('sku', '').strip() or product.sku
             product.name = request.form['name']
             product.description = request.form['description']
             product.price = float(request.form['price'])
             product.stock_quantity = int(request.form['stock_quantity'])
             product.category_id = int(request.form['category_id'])
-            product.image_url = request.form.get('image_url', product.image_url)
+            old_image_url = product.image_url
+            product.image_url = (
+                store_uploaded_image() or request.form.get('image_url', '').strip() or product.image_url
+            )
 
+            touch_carts(db, product_id=product_id)
+            if product.image_url != old_image_url:
+                release_image(db, old_image_url)
             db.commit()
             flash('Товар успешно обновлён', 'success')
             return redirect(url_for('admin_panel'))
@@ -901,9 +1295,123 @@ def edit_product(product_id):
         db.rollback()
         flash(f'Ошибка: {str(e)}', 'danger')
         return redirect(url_for('admin_panel'))
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    # Создаёт недостающие таблицы и применяет миграции; приложение при запуске
+    # схему не меняет
+    applied = db_session.init_db()
+    if applied:
+        for name in applied:
+            click.echo(f'Применена миграция: {name}')
+    else:
+        click.echo('Схема базы данных актуальна')
+
+
+@app.cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None)
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+def import_products_command(path, fmt, batch_size):
+    db = db_session.SessionLocal()
+    try:
+        with open(path, 'rb') as stream:
+            report = import_products(db, read_rows(stream, fmt or detect_format(path)), batch_size=batch_size)
     finally:
         db.close()
 
+    click.echo(f'Создано: {report["created"]}, обновлено: {report["updated"]}, ошибок: {report["error_count"]}')
+    for error in report['errors']:
+        click.echo(f'  строка {error["line"]}: {error["error"]}', err=True)
+
+
+@app.cli.command('export-products')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None)
+def export_products_command(path, fmt):
+    db = db_session.SessionLocal()
+    try:
+        with open(path, 'w', encoding='utf-8', newline='') as output:
+            for chunk in iter_export(db, fmt or detect_format(path)):
+                output.write(chunk)
+    finally:
+        db.close()
+
+
+@app.cli.command('convert-images')
+def convert_images_command():
+    # Переводит загруженные ранее файлы товаров на варианты с хэш-именами
+    db = db_session.SessionLocal()
+    folder = product_image_folder()
+    converted = 0
+    try:
+        for product in db.query(Product).filter(Product.image_url.isnot(None), Product.image_url != ''):
+            if is_image_key(product.image_url) or ':' in product.image_url:
+                continue
+            path = os.path.join(folder, os.path.basename(product.image_url))
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as stream:
+                product.image_url = save_image(stream, folder)
+            converted += 1
+        db.commit()
+    finally:
+        db.close()
+    click.echo(f'Преобразовано изображений: {converted}')
+
+
+@app.cli.command('rebuild-analytics')
+def rebuild_analytics_command():
+    # Пересчёт сводных таблиц продаж по всей истории заказов
+    db = db_session.SessionLocal()
+    try:
+        analytics.rebuild_analytics(db)
+        db.commit()
+    finally:
+        db.close()
+    click.echo('Статистика продаж пересчитана')
+
+
+@app.cli.command('sweep-reservations')
+def sweep_reservations_command():
+    released = sweep_reservations(db_session.SessionLocal)
+    click.echo(f'Снято просроченных резервов: {released}')
+
+
+@app.cli.command('run-jobs')
+@click.option('--processes', default=1, show_default=True, help='число процессов-обработчиков')
+@click.option('--once', is_flag=True, help='выполнить готовые задачи и выйти')
+def run_jobs_command(processes, once):
+    if once:
+        click.echo(f'Выполнено задач: {jobs.run_pending(db_session.SessionLocal)}')
+        return
+    # Дочерние процессы не должны пользоваться соединениями родителя
+    jobs.run_worker_processes(db_session.SessionLocal, processes, db_session.reset_after_fork)
+
+
+def compile_templates():
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    # Заполняет кэш байт-кода шаблонов до запуска воркеров
+    click.echo(f'Скомпилировано шаблонов: {len(compile_templates())}')
+
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    problems = check_query_plans(db_session.get_engine())
+    for name, plan in problems.items():
+        click.echo(f'{name}: {" / ".join(plan)}', err=True)
+    if problems:
+        raise SystemExit(1)
+    click.echo('Все запросы горячего пути используют индексы')
+
 
 if __name__ == '__main__':
     app.run(debug=True)
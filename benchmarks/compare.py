@@ -0,0 +1,55 @@
+import argparse
+import json
+import sys
+
+METRICS = ['p50_ms', 'p95_ms', 'p99_ms', 'rps', 'queries_per_request']
+# Для rps рост — улучшение, для остальных метрик — ухудшение
+HIGHER_IS_BETTER = {'rps'}
+
+
+def load(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)['scenarios']
+
+
+def change(before, after):
+    if before is None or after is None:
+        return None
+    if before == 0:
+        return 0.0 if after == 0 else float('inf')
+    return (after - before) / before * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение двух отчётов benchmarks.run')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='допустимое ухудшение p95 и rps в процентах')
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    regressions = []
+    print(f'{"сценарий":<14}' + ''.join(f'{metric:>28}' for metric in METRICS))
+    for name in sorted(set(baseline) & set(candidate)):
+        cells = []
+        for metric in METRICS:
+            before, after = baseline[name].get(metric), candidate[name].get(metric)
+            delta = change(before, after)
+            cells.append(f'{before} -> {after} ({delta:+.1f}%)' if delta is not None else f'{before} -> {after}')
+            if delta is None:
+                continue
+            worse = -delta if metric in HIGHER_IS_BETTER else delta
+            if metric == 'queries_per_request' and after > before:
+                regressions.append(f'{name}: {metric} {before} -> {after}')
+            elif metric in ('p95_ms', 'rps') and worse > args.threshold:
+                regressions.append(f'{name}: {metric} {before} -> {after} ({delta:+.1f}%)')
+        print(f'{name:<14}' + ''.join(f'{cell:>28}' for cell in cells))
+
+    if regressions:
+        print('\nУхудшения:', *regressions, sep='\n  ')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from .seed import SCALES, BENCH_PASSWORD, BENCH_PROMO, prepare_database
+
+SCENARIOS = ['home', 'view_cart', 'add_to_cart', 'update_cart', 'apply_promo', 'delivery', 'orders']
+ADDRESS = {'country': 'Россия', 'city': 'Москва', 'street': 'Тверская', 'house': '1', 'promo_code': BENCH_PROMO}
+
+_queries = threading.local()
+
+
+def count_queries(db_engine):
+    from sqlalchemy import event
+
+    @event.listens_for(db_engine, 'before_cursor_execute')
+    def _count(*args):
+        _queries.count = getattr(_queries, 'count', 0) + 1
+
+
+class TestClient:
+    # Запросы через Flask test client в том же процессе; считает SQL-запросы
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, json_body=None):
+        _queries.count = 0
+        response = self.client.open(path, method=method, data=data, json=json_body, headers={'Referer': '/'})
+        return response.status_code, _queries.count
+
+
+class HttpClient:
+    # Запросы к запущенному серверу; редиректы не выполняются, чтобы мерить
+    # ровно один запрос
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect
+        )
+
+    def request(self, method, path, data=None, json_body=None):
+        headers = {'Referer': self.base_url + '/'}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status, None
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+
+def percentile(values, percent):
+    # Метод ближайшего ранга
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+class Shopper:
+    # Один пользователь со своим клиентом (своя сессия) и позицией корзины,
+    # которую меняет сценарий update_cart
+    def __init__(self, client, user_id, cart_item_id, product_ids, rnd):
+        self.client = client
+        self.user_id = user_id
+        self.cart_item_id = cart_item_id
+        self.product_ids = product_ids
+        self.rnd = rnd
+        self.step = 0
+
+    def login(self):
+        status, _ = self.client.request('POST', '/login', data={
+            'email': f'user{self.user_id}@bench.local', 'password': BENCH_PASSWORD
+        })
+        if status != 302:
+            raise RuntimeError(f'Не удалось войти пользователем {self.user_id}: {status}')
+
+    def add_random_product(self):
+        return self.client.request('POST', f'/add_to_cart/{self.rnd.choice(self.product_ids)}')
+
+    # Каждый сценарий возвращает (ожидаемые коды, подготовка вне замера, запрос)
+    def home(self):
+        return {200}, None, ('GET', '/')
+
+    def view_cart(self):
+        return {200}, None, ('GET', '/cart')
+
+    def add_to_cart(self):
+        return {302}, None, ('POST', f'/add_to_cart/{self.rnd.choice(self.product_ids)}')
+
+    def update_cart(self):
+        self.step += 1
+        action = 'increment' if self.step % 2 else 'decrement'
+        return {302}, None, ('POST', f'/update_cart/{self.cart_item_id}', {'action': action})
+
+    def apply_promo(self):
+        return {200}, None, ('POST', '/api/apply_promo', None, {'code': BENCH_PROMO})
+
+    def delivery(self):
+        return {302}, self.add_random_product, ('POST', '/delivery', ADDRESS)
+
+    def orders(self):
+        return {200}, None, ('GET', '/orders')
+
+
+def run_scenario(name, shoppers, requests, concurrency, warmup):
+    for shopper in shoppers[:warmup]:
+        expected, prepare, call = getattr(shopper, name)()
+        if prepare:
+            prepare()
+        shopper.client.request(*call)
+
+    durations, queries, errors = [], [], []
+    lock = threading.Lock()
+    per_thread = max(requests // concurrency, 1)
+    barrier = threading.Barrier(concurrency)
+
+    def worker(index):
+        own = shoppers[index::concurrency]
+        local_durations, local_queries, local_errors = [], [], []
+        barrier.wait()
+        for step in range(per_thread):
+            shopper = own[step % len(own)]
+            expected, prepare, call = getattr(shopper, name)()
+            if prepare:
+                prepare()
+            started = time.perf_counter()
+            status, query_count = shopper.client.request(*call)
+            local_durations.append(time.perf_counter() - started)
+            if query_count is not None:
+                local_queries.append(query_count)
+            if status not in expected:
+                local_errors.append(status)
+        with lock:
+            durations.extend(local_durations)
+            queries.extend(local_queries)
+            errors.extend(local_errors)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests': len(durations),
+        'errors': len(errors),
+        'error_statuses': sorted(set(errors)),
+        'rps': round(len(durations) / elapsed, 1),
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 2),
+        'p50_ms': round(percentile(durations, 50) * 1000, 2),
+        'p95_ms': round(percentile(durations, 95) * 1000, 2),
+        'p99_ms': round(percentile(durations, 99) * 1000, 2),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None
+    }
+
+
+def load_fixtures(path, users):
+    # Позиции корзин и товары для сценариев читаются напрямую из файла базы
+    connection = sqlite3.connect(path)
+    try:
+        items = dict(connection.execute(
+            'SELECT carts.user_id, min(cart_items.id) FROM cart_items '
+            'JOIN carts ON carts.id = cart_items.cart_id GROUP BY carts.user_id'
+        ))
+        product_ids = [row[0] for row in connection.execute('SELECT id FROM products ORDER BY id LIMIT 1000')]
+    finally:
+        connection.close()
+    user_ids = [user_id for user_id in sorted(items) if user_id != 1][:users]
+    return [(user_id, items[user_id]) for user_id in user_ids], product_ids
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк основных сценариев магазина')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--requests', type=int, default=200, help='запросов на сценарий')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--shoppers', type=int, default=20, help='число пользователей в сценариях')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='можно указать несколько раз')
+    parser.add_argument('--database', help='файл базы; по умолчанию временный')
+    parser.add_argument('--no-seed', action='store_true', help='использовать уже заполненную базу --database')
+    parser.add_argument('--url', help='адрес запущенного сервера вместо Flask test client')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='файл для JSON-отчёта; по умолчанию stdout')
+    args = parser.parse_args()
+
+    if args.no_seed and not args.database:
+        parser.error('--no-seed требует --database')
+    if args.url and not args.database:
+        parser.error('--url требует --database той же базы, с которой работает сервер')
+
+    workdir = None
+    path = args.database
+    if not path:
+        workdir = tempfile.mkdtemp(prefix='shop-bench-')
+        path = os.path.join(workdir, 'bench.db')
+
+    started = time.perf_counter()
+    if args.no_seed:
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(path)}'
+    else:
+        prepare_database(path, args.scale, args.seed)
+    seed_seconds = time.perf_counter() - started
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        from app import app
+        from data import db_session
+        count_queries(db_session.get_engine())
+        make_client = lambda: TestClient(app)
+
+    fixtures, product_ids = load_fixtures(path, args.shoppers)
+    if not fixtures:
+        raise SystemExit('В базе нет пользователей с непустой корзиной')
+    rnd = random.Random(args.seed)
+    shoppers = [
+        Shopper(make_client(), user_id, cart_item_id, product_ids, random.Random(rnd.random()))
+        for user_id, cart_item_id in fixtures
+    ]
+    for shopper in shoppers:
+        shopper.login()
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        results[name] = run_scenario(name, shoppers, args.requests, args.concurrency, args.warmup)
+        print(f'{name}: {results[name]}', file=sys.stderr)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'mode': 'http' if args.url else 'test_client',
+            'scale': None if args.no_seed else args.scale,
+            'dataset': None if args.no_seed else SCALES[args.scale],
+            'seed_seconds': round(seed_seconds, 2),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'shoppers': len(shoppers)
+        },
+        'scenarios': results
+    }
+
+    if workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+# Размеры синтетической базы. carts и orders — число пользователей с непустой
+# корзиной и общее число заказов.
+SCALES = {
+    'small': {'users': 50, 'categories': 5, 'products': 500, 'carts': 25, 'orders': 500},
+    'medium': {'users': 500, 'categories': 20, 'products': 10000, 'carts': 250, 'orders': 10000},
+    'large': {'users': 5000, 'categories': 50, 'products': 100000, 'carts': 2500, 'orders': 100000},
+}
+
+BENCH_PASSWORD = 'bench'
+BENCH_PROMO = 'BENCH10'
+BENCH_STOCK = 10 ** 9
+BATCH_SIZE = 5000
+
+WORDS = [
+    'ноутбук', 'смартфон', 'наушники', 'кабель', 'чехол', 'монитор', 'клавиатура', 'мышь',
+    'футболка', 'джинсы', 'куртка', 'кроссовки', 'рюкзак', 'часы', 'лампа', 'книга',
+    'игровой', 'беспроводной', 'компактный', 'мощный', 'лёгкий', 'тёплый', 'складной', 'умный'
+]
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(db, model, rows):
+    for batch in _batches(rows):
+        db.execute(model.__table__.insert(), batch)
+
+
+def seed(db, users, categories, products, carts, orders, random_seed=42):
+    # Заполняет пустую базу детерминированными данными: при одинаковом
+    # random_seed получается одна и та же база
+    from data.__all_models import (
+        User, Category, Product, Cart, CartItem, Order, OrderItem, DeliveryAddress, PromoCode
+    )
+
+    rnd = random.Random(random_seed)
+    now = datetime(2025, 1, 1)
+
+    _insert(db, Category, ({'id': i, 'name': f'Категория {i}'} for i in range(1, categories + 1)))
+    _insert(db, User, (
+        {
+            'id': i, 'name': f'Имя{i}', 'surname': f'Фамилия{i}', 'email': f'user{i}@bench.local',
+            'password': BENCH_PASSWORD, 'phone': f'+79{i:09d}', 'is_admin': i == 1, 'created_at': now
+        }
+        for i in range(1, users + 1)
+    ))
+
+    prices = {}
+
+    def product_rows():
+        for i in range(1, products + 1):
+            prices[i] = round(rnd.uniform(100, 100000), 2)
+            yield {
+                'id': i, 'sku': f'B{i:08d}',
+                'name': f'{rnd.choice(WORDS).capitalize()} {rnd.choice(WORDS)} {i}',
+                'description': ' '.join(rnd.choice(WORDS) for _ in range(12)),
+                'price': prices[i], 'stock_quantity': BENCH_STOCK,
+                'category_id': rnd.randint(1, categories)
+            }
+
+    _insert(db, Product, product_rows())
+    _insert(db, PromoCode, [{
+        'code': BENCH_PROMO, 'discount': 10, 'max_activations': 10 ** 9, 'activations_count': 0,
+        'start_date': now, 'end_date': None, 'is_active': True, 'is_reusable': True
+    }])
+
+    _insert(db, Cart, ({'id': i, 'user_id': i, 'version': 0} for i in range(1, users + 1)))
+
+    def cart_item_rows():
+        for user_id in range(1, min(carts, users) + 1):
+            for product_id in rnd.sample(range(1, products + 1), min(5, products)):
+                yield {'cart_id': user_id, 'product_id': product_id, 'quantity': rnd.randint(1, 3)}
+
+    _insert(db, CartItem, cart_item_rows())
+
+    order_items = []
+    addresses = []
+
+    def order_rows():
+        for order_id in range(1, orders + 1):
+            user_id = rnd.randint(1, users)
+            lines = [(product_id, rnd.randint(1, 3)) for product_id in rnd.sample(range(1, products + 1), min(3, products))]
+            for product_id, quantity in lines:
+                order_items.append({
+                    'order_id': order_id, 'product_id': product_id,
+                    'quantity': quantity, 'price_at_purchase': prices[product_id]
+                })
+            addresses.append({
+                'order_id': order_id, 'country': 'Россия', 'city': 'Москва', 'street': 'Тверская',
+                'house': str(rnd.randint(1, 200)), 'apartment': '', 'additional_info': '',
+                'phone': f'+79{user_id:09d}'
+            })
+            yield {
+                'id': order_id, 'user_id': user_id, 'status': 'Ожидает оплаты', 'promo_code': None,
+                'total_amount': round(sum(prices[product_id] * quantity for product_id, quantity in lines), 2),
+                'created_at': now - timedelta(minutes=orders - order_id)
+            }
+
+    _insert(db, Order, order_rows())
+    _insert(db, OrderItem, order_items)
+    _insert(db, DeliveryAddress, addresses)
+    db.commit()
+
+
+def prepare_database(path, scale, random_seed=42):
+    # Создаёт базу с нуля по пути path. DATABASE_URL выставляется, чтобы
+    # приложение, импортированное после, работало с той же базой.
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(path)}'
+
+    from data import db_session
+    db_session.global_init(os.path.abspath(path))
+    db = db_session.SessionLocal()
+    try:
+        seed(db, random_seed=random_seed, **SCALES[scale])
+    finally:
+        db.close()
+    return db_session
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заполнение синтетической базы для бенчмарков')
+    parser.add_argument('path', help='путь к файлу SQLite, существующий файл будет перезаписан')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    prepare_database(args.path, args.scale, args.seed)
+    print(f'База {args.path} заполнена: {SCALES[args.scale]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from .run import percentile, git_revision
+from .seed import SCALES, prepare_database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Выполняется в свежем процессе: время импорта приложения и первого запроса.
+# ready — от запуска процесса (метка родителя) до ответа на первый запрос.
+PROBE = '''
+import importlib, json, os, sys, time
+started = time.perf_counter()
+module = importlib.import_module(sys.argv[2])
+imported = time.perf_counter()
+application = getattr(module, 'application', None) or module.app
+status = application.test_client().get(sys.argv[1]).status_code
+answered = time.perf_counter()
+print(json.dumps({
+    'status': status,
+    'import': imported - started,
+    'first_request': answered - imported,
+    'ready': time.time() - float(os.environ['STARTUP_SPAWNED_AT'])
+}))
+'''
+
+METRICS = ['import', 'first_request', 'ready']
+
+
+def probe(database_path, path, entry):
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{os.path.abspath(database_path)}',
+               STARTUP_SPAWNED_AT=repr(time.time()))
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE, path, entry], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(samples, errors):
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'rps': None,
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 2),
+        'p50_ms': round(percentile(samples, 50) * 1000, 2),
+        'p95_ms': round(percentile(samples, 95) * 1000, 2),
+        'p99_ms': round(percentile(samples, 99) * 1000, 2),
+        'queries_per_request': None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время холодного старта: от запуска процесса до первого ответа')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--path', default='/', help='адрес первого запроса')
+    parser.add_argument('--entry', choices=['app', 'wsgi'], default='app',
+                        help='модуль приложения: app (flask run) или wsgi (gunicorn)')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--database', help='готовая база (после flask migrate); по умолчанию временная')
+    parser.add_argument('--output', help='файл для JSON-отчёта; по умолчанию stdout')
+    args = parser.parse_args()
+
+    workdir = None
+    path = args.database
+    if not path:
+        workdir = tempfile.mkdtemp(prefix='shop-startup-')
+        path = os.path.join(workdir, 'startup.db')
+        prepare_database(path, args.scale)
+
+    for _ in range(args.warmup):
+        probe(path, args.path, args.entry)
+    samples = {metric: [] for metric in METRICS}
+    errors = 0
+    for _ in range(args.runs):
+        result = probe(path, args.path, args.entry)
+        errors += result['status'] >= 400
+        for metric in METRICS:
+            samples[metric].append(result[metric])
+    results = {metric: summarize(values, errors) for metric, values in samples.items()}
+    for name, result in results.items():
+        print(f'{name}: {result}', file=sys.stderr)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'mode': 'startup',
+            'path': args.path,
+            'entry': args.entry,
+            'runs': args.runs
+        },
+        'scenarios': results
+    }
+
+    if workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
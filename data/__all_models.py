@@ -1,15 +1,10 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, Numeric, DECIMAL, TIMESTAMP, Boolean, Float, DateTime
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Numeric, DECIMAL, TIMESTAMP, Boolean, Float, DateTime, Date, Index
 from sqlalchemy.orm import relationship, declarative_base
-import pytz
-from datetime import datetime
+from .timeutils import utcnow
 
 Base = declarative_base()
 
 
-def moscow_time():
-    return datetime.now(pytz.timezone('Europe/Moscow'))
-
-
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
@@ -19,20 +14,26 @@ class User(Base):
     password = Column(String(255), nullable=False)
     phone = Column(String(20), nullable=False)
     is_admin = Column(Boolean, default=False)
-    created_at = Column(TIMESTAMP, default=moscow_time)
+    created_at = Column(TIMESTAMP, default=utcnow)
     orders = relationship("Order", back_populates="user", lazy='dynamic')
     cart = relationship("Cart", uselist=False, back_populates="user")
 
 
 class Product(Base):
     __tablename__ = "products"
+    __table_args__ = (
+        Index('uq_products_sku', 'sku', unique=True),
+    )
     id = Column(Integer, primary_key=True)
-    name = Column(String(255), nullable=False)
+    sku = Column(String(64))
+    name = Column(String(255), nullable=False, index=True)
     description = Column(Text)
     price = Column(DECIMAL(10, 2), nullable=False)
     stock_quantity = Column(Integer, default=0)
+    reserved_quantity = Column(Integer, nullable=False, default=0, server_default='0')
+    version = Column(Integer, nullable=False, default=0, server_default='0')
     image_url = Column(String(255))
-    category_id = Column(Integer, ForeignKey('categories.id'))
+    category_id = Column(Integer, ForeignKey('categories.id'), index=True)
     category = relationship("Category", back_populates="products")
     cart_items = relationship("CartItem", back_populates="product")
     order_items = relationship("OrderItem", back_populates="product")
@@ -42,34 +43,58 @@ class Category(Base):
     __tablename__ = "categories"
     id = Column(Integer, primary_key=True)
     name = Column(String(100), unique=True, nullable=False)
+    product_count = Column(Integer, nullable=False, default=0, server_default='0')
     products = relationship("Product", back_populates="category")
 
 
 class Cart(Base):
     __tablename__ = "carts"
+    __table_args__ = (
+        Index('uq_carts_user_id', 'user_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
+    version = Column(Integer, nullable=False, default=0, server_default='0')
     user = relationship("User", back_populates="cart")
     items = relationship("CartItem", back_populates="cart")
 
 
 class CartItem(Base):
     __tablename__ = "cart_items"
+    __table_args__ = (
+        Index('uq_cart_items_cart_product', 'cart_id', 'product_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     quantity = Column(Integer, nullable=False)
     cart_id = Column(Integer, ForeignKey('carts.id'))
-    product_id = Column(Integer, ForeignKey('products.id'))
+    product_id = Column(Integer, ForeignKey('products.id'), index=True)
     cart = relationship("Cart", back_populates="items")
     product = relationship("Product", lazy='joined')
 
 
+class StockReservation(Base):
+    __tablename__ = "stock_reservations"
+    __table_args__ = (
+        Index('uq_stock_reservations_cart_product', 'cart_id', 'product_id', unique=True),
+    )
+    id = Column(Integer, primary_key=True)
+    cart_id = Column(Integer, ForeignKey('carts.id'), nullable=False)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index('ix_orders_user_id_promo_code', 'user_id', 'promo_code'),
+        Index('ix_orders_user_id_created_at', 'user_id', 'created_at'),
+    )
     id = Column(Integer, primary_key=True)
     promo_code = Column(String(50), nullable=True)
     total_amount = Column(DECIMAL(10, 2), nullable=False)
     status = Column(String(20), default="pending")
-    created_at = Column(TIMESTAMP, default=moscow_time)
+    created_at = Column(TIMESTAMP, default=utcnow)
     user_id = Column(Integer, ForeignKey('users.id'))
     user = relationship("User", back_populates="orders")
     items = relationship("OrderItem", back_populates="order")
@@ -81,7 +106,7 @@ class OrderItem(Base):
     id = Column(Integer, primary_key=True)
     quantity = Column(Integer, nullable=False)
     price_at_purchase = Column(DECIMAL(10, 2), nullable=False)
-    order_id = Column(Integer, ForeignKey('orders.id'))
+    order_id = Column(Integer, ForeignKey('orders.id'), index=True)
     product_id = Column(Integer, ForeignKey('products.id'))
     order = relationship("Order", back_populates="items")
     product = relationship("Product", back_populates="order_items")
@@ -109,7 +134,59 @@ class PromoCode(Base):
     discount = Column(Numeric(5, 2), nullable=False)
     max_activations = Column(Integer, nullable=False, default=1)
     activations_count = Column(Integer, default=0, nullable=False)
-    start_date = Column(DateTime, default=datetime.utcnow)
+    start_date = Column(DateTime, default=utcnow)
     end_date = Column(DateTime)
     is_active = Column(Boolean, default=True)
     is_reusable = Column(Boolean, default=False)
+
+
+class Job(Base):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        Index('uq_jobs_idempotency_key', 'idempotency_key', unique=True),
+        Index('ix_jobs_status_run_after', 'status', 'run_after'),
+    )
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100), nullable=False)
+    payload = Column(Text, nullable=False, default='{}')
+    idempotency_key = Column(String(255))
+    status = Column(String(20), nullable=False, default='queued')
+    attempts = Column(Integer, nullable=False, default=0)
+    run_after = Column(DateTime, nullable=False, default=utcnow)
+    locked_by = Column(String(255))
+    locked_at = Column(DateTime)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=utcnow)
+    finished_at = Column(DateTime)
+
+
+class SalesDaily(Base):
+    __tablename__ = 'sales_daily'
+    day = Column(Date, primary_key=True)
+    orders_count = Column(Integer, nullable=False, default=0)
+    units = Column(Integer, nullable=False, default=0)
+    revenue_cents = Column(Integer, nullable=False, default=0)
+    discount_cents = Column(Integer, nullable=False, default=0)
+
+
+class ProductSales(Base):
+    __tablename__ = 'product_sales'
+    product_id = Column(Integer, primary_key=True)
+    orders_count = Column(Integer, nullable=False, default=0)
+    units = Column(Integer, nullable=False, default=0)
+    revenue_cents = Column(Integer, nullable=False, default=0)
+
+
+class CategorySales(Base):
+    __tablename__ = 'category_sales'
+    category_id = Column(Integer, primary_key=True)
+    units = Column(Integer, nullable=False, default=0)
+    revenue_cents = Column(Integer, nullable=False, default=0)
+
+
+class PromoUsage(Base):
+    __tablename__ = 'promo_usage'
+    code = Column(String(50), primary_key=True)
+    orders_count = Column(Integer, nullable=False, default=0)
+    revenue_cents = Column(Integer, nullable=False, default=0)
+    discount_cents = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,207 @@
+from datetime import timedelta
+from decimal import Decimal
+from sqlalchemy import text, desc
+from sqlalchemy.dialects.sqlite import insert
+from .__all_models import Product, Category, Order, OrderItem, SalesDaily, ProductSales, CategorySales, PromoUsage
+from .timeutils import utcnow
+
+# Сводные таблицы продаж. Оформление заказа ставит в очередь задачу
+# record_order, которая прибавляет заказ к сводкам, поэтому отчёты читают уже
+# посчитанные строки и не зависят от числа заказов. Суммы хранятся в копейках.
+# Выручка по дням и промокодам — итог заказа со скидкой, по товарам и
+# категориям — сумма позиций до скидки. Дни считаются по UTC, как и
+# Order.created_at.
+NO_CATEGORY_ID = 0
+PRODUCT_SORTS = {'units': ProductSales.units, 'revenue': ProductSales.revenue_cents}
+
+
+def to_cents(amount):
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1')))
+
+
+def _upsert(model, key, counters):
+    # INSERT ... ON CONFLICT DO UPDATE, прибавляющий значения к счётчикам;
+    # выполняется через executemany со списком строк
+    table = model.__table__
+    statement = insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c[name] for name in key],
+        set_={name: table.c[name] + statement.excluded[name] for name in counters}
+    )
+
+
+def record_order(db, order, lines, subtotal):
+    total_cents = to_cents(order.total_amount)
+    discount_cents = max(to_cents(subtotal) - total_cents, 0) if order.promo_code else 0
+
+    db.execute(_upsert(SalesDaily, ['day'], ['orders_count', 'units', 'revenue_cents', 'discount_cents']), [{
+        'day': order.created_at.date(),
+        'orders_count': 1,
+        'units': sum(line.quantity for line in lines),
+        'revenue_cents': total_cents,
+        'discount_cents': discount_cents
+    }])
+
+    products = []
+    categories = {}
+    for line in lines:
+        line_cents = to_cents(line.price) * line.quantity
+        products.append({
+            'product_id': line.product_id, 'orders_count': 1, 'units': line.quantity, 'revenue_cents': line_cents
+        })
+        category = categories.setdefault(line.category_id or NO_CATEGORY_ID, {
+            'category_id': line.category_id or NO_CATEGORY_ID, 'units': 0, 'revenue_cents': 0
+        })
+        category['units'] += line.quantity
+        category['revenue_cents'] += line_cents
+
+    db.execute(_upsert(ProductSales, ['product_id'], ['orders_count', 'units', 'revenue_cents']), products)
+    db.execute(_upsert(CategorySales, ['category_id'], ['units', 'revenue_cents']), list(categories.values()))
+
+    if order.promo_code:
+        db.execute(_upsert(PromoUsage, ['code'], ['orders_count', 'revenue_cents', 'discount_cents']), [{
+            'code': order.promo_code, 'orders_count': 1, 'revenue_cents': total_cents, 'discount_cents': discount_cents
+        }])
+
+
+def record_order_by_id(db, order_id):
+    # Задача очереди: строки заказа читаются из order_items, категория — из
+    # текущего товара
+    order = db.query(Order).get(order_id)
+    if order is None:
+        return
+    lines = db.query(
+        OrderItem.product_id, OrderItem.quantity, OrderItem.price_at_purchase.label('price'), Product.category_id
+    ).outerjoin(Product, Product.id == OrderItem.product_id).filter(OrderItem.order_id == order_id).all()
+    subtotal = sum((Decimal(str(line.price)) * line.quantity for line in lines), Decimal('0'))
+    record_order(db, order, lines, subtotal)
+
+
+_ORDER_GROSS = """
+    SELECT order_id, sum(quantity) AS units,
+           sum(CAST(round(price_at_purchase * 100) AS INTEGER) * quantity) AS gross_cents
+    FROM order_items GROUP BY order_id
+"""
+_ORDER_TOTALS = f"""
+    SELECT orders.id, orders.created_at, orders.promo_code,
+           coalesce(items.units, 0) AS units,
+           CAST(round(orders.total_amount * 100) AS INTEGER) AS total_cents,
+           CASE WHEN orders.promo_code IS NULL THEN 0
+                ELSE max(coalesce(items.gross_cents, 0) - CAST(round(orders.total_amount * 100) AS INTEGER), 0)
+           END AS discount_cents
+    FROM orders LEFT JOIN ({_ORDER_GROSS}) AS items ON items.order_id = orders.id
+"""
+RECORD_ORDER_TASK = 'analytics.record_order'
+REBUILD_STATEMENTS = [
+    f"DELETE FROM jobs WHERE name = '{RECORD_ORDER_TASK}' AND status IN ('queued', 'running')",
+    "DELETE FROM sales_daily",
+    "DELETE FROM product_sales",
+    "DELETE FROM category_sales",
+    "DELETE FROM promo_usage",
+    f"""
+    INSERT INTO sales_daily (day, orders_count, units, revenue_cents, discount_cents)
+    SELECT date(created_at), count(*), sum(units), sum(total_cents), sum(discount_cents)
+    FROM ({_ORDER_TOTALS}) GROUP BY date(created_at)
+    """,
+    """
+    INSERT INTO product_sales (product_id, orders_count, units, revenue_cents)
+    SELECT product_id, count(DISTINCT order_id), sum(quantity),
+           sum(CAST(round(price_at_purchase * 100) AS INTEGER) * quantity)
+    FROM order_items WHERE product_id IS NOT NULL GROUP BY product_id
+    """,
+    f"""
+    INSERT INTO category_sales (category_id, units, revenue_cents)
+    SELECT coalesce(products.category_id, {NO_CATEGORY_ID}), sum(order_items.quantity),
+           sum(CAST(round(order_items.price_at_purchase * 100) AS INTEGER) * order_items.quantity)
+    FROM order_items LEFT JOIN products ON products.id = order_items.product_id
+    GROUP BY coalesce(products.category_id, {NO_CATEGORY_ID})
+    """,
+    f"""
+    INSERT INTO promo_usage (code, orders_count, revenue_cents, discount_cents)
+    SELECT promo_code, count(*), sum(total_cents), sum(discount_cents)
+    FROM ({_ORDER_TOTALS}) WHERE promo_code IS NOT NULL GROUP BY promo_code
+    """,
+]
+
+
+def rebuild_analytics(connection):
+    # Пересчитывает сводные таблицы по всей истории заказов. Выполняется в
+    # транзакции вызывающего кода: первый DELETE берёт блокировку записи, и
+    # оформляемые параллельно заказы попадут в сводку уже после пересчёта.
+    # Ждущие в очереди задачи record_order удаляются: их заказы уже учтены.
+    # Категории берутся текущие — история смены категорий не хранится.
+    for statement in REBUILD_STATEMENTS:
+        connection.execute(text(statement))
+
+
+def _rubles(cents):
+    return float(Decimal(cents or 0) / 100)
+
+
+def daily_sales(db, days=30, end=None):
+    end = end or utcnow().date()
+    start = end - timedelta(days=days - 1)
+    rows = db.query(SalesDaily).filter(SalesDaily.day.between(start, end)).order_by(SalesDaily.day).all()
+    result = [
+        {
+            'day': row.day.isoformat(),
+            'orders': row.orders_count,
+            'units': row.units,
+            'revenue': _rubles(row.revenue_cents),
+            'discount': _rubles(row.discount_cents),
+            'average_order': _rubles(row.revenue_cents // row.orders_count) if row.orders_count else 0.0
+        }
+        for row in rows
+    ]
+    totals = {
+        'orders': sum(row.orders_count for row in rows),
+        'units': sum(row.units for row in rows),
+        'revenue': _rubles(sum(row.revenue_cents for row in rows)),
+        'discount': _rubles(sum(row.discount_cents for row in rows))
+    }
+    return {'from': start.isoformat(), 'to': end.isoformat(), 'days': result, 'totals': totals}
+
+
+def top_products(db, limit=20, sort='revenue'):
+    rows = db.query(ProductSales, Product.name, Product.sku).outerjoin(
+        Product, Product.id == ProductSales.product_id
+    ).order_by(desc(PRODUCT_SORTS.get(sort, ProductSales.revenue_cents)), ProductSales.product_id).limit(limit).all()
+    return [
+        {
+            'product_id': stats.product_id,
+            'sku': sku,
+            'name': name,
+            'orders': stats.orders_count,
+            'units': stats.units,
+            'revenue': _rubles(stats.revenue_cents)
+        }
+        for stats, name, sku in rows
+    ]
+
+
+def category_sales(db):
+    rows = db.query(CategorySales, Category.name).outerjoin(
+        Category, Category.id == CategorySales.category_id
+    ).order_by(desc(CategorySales.revenue_cents)).all()
+    return [
+        {
+            'category_id': stats.category_id or None,
+            'name': name,
+            'units': stats.units,
+            'revenue': _rubles(stats.revenue_cents)
+        }
+        for stats, name in rows
+    ]
+
+
+def promo_usage(db):
+    rows = db.query(PromoUsage).order_by(desc(PromoUsage.orders_count)).all()
+    return [
+        {
+            'code': row.code,
+            'orders': row.orders_count,
+            'revenue': _rubles(row.revenue_cents),
+            'discount': _rubles(row.discount_cents)
+        }
+        for row in rows
+    ]
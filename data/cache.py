@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import text
+
+_MISSING = object()
+
+
+class LRUCache:
+    # Небольшой потокобезопасный кэш внутри процесса: вытесняет самые старые
+    # ключи при переполнении и (если задан ttl) считает записи устаревшими
+    # через ttl секунд. В разных воркерах кэши независимы, поэтому ttl
+    # ограничивает время, в течение которого другой процесс видит старые данные.
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Общие кэши приложения: число товаров в корзине для шапки по user_id (его
+# сбрасывают и HTML-страницы, и API) и готовые фрагменты каталога (ключи с
+# версией каталога, не сбрасываются).
+cart_count_cache = LRUCache(maxsize=4096, ttl=60)
+catalog_cache = LRUCache(maxsize=512, ttl=300)
+
+
+def get_catalog_version(db):
+    # Версия каталога общая для всех процессов: её увеличивают триггеры
+    # базы (миграция 7), поэтому ключи с версией не требуют сброса кэшей
+    return db.execute(text('SELECT version FROM catalog_version WHERE id = 1')).scalar() or 0
@@ -0,0 +1,175 @@
+from collections import namedtuple
+from decimal import Decimal
+from sqlalchemy import select, literal, update, func, cast, Integer
+from sqlalchemy.dialects.sqlite import insert
+from .__all_models import Product, Category, Cart, CartItem
+from .cache import LRUCache
+from .reservations import hold_stock, available_for_cart
+
+CartTotals = namedtuple('CartTotals', 'cart_id version subtotal items_count')
+
+# Итоги корзины кэшируются по (id корзины, версия). Версия увеличивается при
+# каждом изменении корзины (touch_carts), поэтому старые записи просто
+# перестают запрашиваться и вытесняются.
+_totals_cache = LRUCache(maxsize=4096)
+
+# Цена в копейках: суммирование целых чисел в SQLite не теряет точность
+_PRICE_CENTS = cast(func.round(Product.price * 100), Integer)
+
+
+class CartError(Exception):
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.message = message
+        self.reason = reason
+
+
+def ensure_cart(db, user_id):
+    # Создаёт корзину при первом обращении, а для существующей увеличивает
+    # версию; ON CONFLICT ... DO UPDATE нужен ещё и для того, чтобы RETURNING
+    # вернул id в обоих случаях
+    statement = insert(Cart).values(user_id=user_id)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Cart.user_id],
+        set_={'version': Cart.version + 1}
+    ).returning(Cart.id)
+    return db.execute(statement).scalar_one()
+
+
+def add_item(db, user_id, product_id):
+    # Добавляет единицу товара одним INSERT ... ON CONFLICT DO UPDATE и
+    # подтягивает резерв корзины до нового количества. Если свободного
+    # остатка не хватает, выбрасывает CartError, и вызывающий код
+    # откатывает транзакцию вместе с изменением позиции. Возвращает новое
+    # количество; коммит остаётся за вызывающим кодом.
+    cart_id = ensure_cart(db, user_id)
+
+    source = select(
+        literal(cart_id), Product.id, literal(1)
+    ).where(Product.id == product_id)
+    statement = insert(CartItem).from_select(
+        [CartItem.cart_id, CartItem.product_id, CartItem.quantity], source
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[CartItem.cart_id, CartItem.product_id],
+        set_={'quantity': CartItem.quantity + 1}
+    ).returning(CartItem.quantity)
+
+    quantity = db.execute(statement).scalar()
+    if quantity is not None and hold_stock(db, cart_id, product_id, quantity):
+        return quantity
+    raise _stock_error(db, cart_id, product_id)
+
+
+def _stock_error(db, cart_id, product_id):
+    product = db.query(
+        Product.name, Product.stock_quantity, available_for_cart(cart_id, product_id).label('available')
+    ).filter(Product.id == product_id).first()
+    if not product or not product.stock_quantity or product.stock_quantity < 1:
+        return CartError('Товар недоступен', 'unavailable')
+    if product.available < 1:
+        return CartError(f'Товар {product.name} зарезервирован другими покупателями', 'unavailable')
+    return CartError(
+        f'Максимальное количество товара {product.name} - {product.available}',
+        'stock_limit'
+    )
+
+
+def set_item_quantity(db, user_id, item_id, quantity=None, delta=0):
+    # Устанавливает количество позиции корзины пользователя (или меняет его на
+    # delta); 0 удаляет позицию и снимает резерв. Коммит остаётся за
+    # вызывающим кодом.
+    item = db.query(
+        CartItem.cart_id, CartItem.product_id, CartItem.quantity
+    ).join(Cart, Cart.id == CartItem.cart_id).filter(
+        CartItem.id == item_id, Cart.user_id == user_id
+    ).first()
+    if not item:
+        raise CartError('Элемент не найден', 'not_found')
+
+    quantity = max(item.quantity + delta if quantity is None else quantity, 0)
+    if not hold_stock(db, item.cart_id, item.product_id, quantity):
+        if quantity > item.quantity:
+            raise _stock_error(db, item.cart_id, item.product_id)
+        # Уменьшение проходит всегда. Если резерв корзины истёк и товар успели
+        # зарезервировать другие, держим столько, сколько осталось свободно;
+        # остаток окончательно проверит оформление заказа
+        available = db.query(available_for_cart(item.cart_id, item.product_id)).filter(
+            Product.id == item.product_id
+        ).scalar() or 0
+        hold_stock(db, item.cart_id, item.product_id, max(min(quantity, available), 0))
+
+    if quantity == 0:
+        db.query(CartItem).filter(CartItem.id == item_id).delete(synchronize_session=False)
+    else:
+        db.query(CartItem).filter(CartItem.id == item_id).update(
+            {'quantity': quantity}, synchronize_session=False
+        )
+    touch_carts(db, cart_id=item.cart_id)
+    return quantity
+
+
+def touch_carts(db, cart_id=None, product_id=None, product_ids=None):
+    # Увеличивает версию корзины (или всех корзин, где есть товар product_id
+    # или один из product_ids), чтобы закэшированные итоги пересчитались
+    statement = update(Cart).values(version=Cart.version + 1)
+    if cart_id is not None:
+        statement = statement.where(Cart.id == cart_id)
+    elif product_id is not None or product_ids is not None:
+        product_ids = [product_id] if product_id is not None else product_ids
+        statement = statement.where(Cart.id.in_(
+            select(CartItem.cart_id).where(CartItem.product_id.in_(product_ids))
+        ))
+    db.execute(statement.execution_options(synchronize_session=False))
+
+
+def get_cart_totals(db, user_id):
+    cart = db.query(Cart.id, Cart.version).filter(Cart.user_id == user_id).first()
+    if not cart:
+        return CartTotals(None, 0, Decimal('0.00'), 0)
+
+    key = (cart.id, cart.version)
+    totals = _totals_cache.get(key)
+    if totals is None:
+        cents, items_count = db.query(
+            func.coalesce(func.sum(_PRICE_CENTS * CartItem.quantity), 0),
+            func.coalesce(func.sum(CartItem.quantity), 0)
+        ).join(Product, Product.id == CartItem.product_id).filter(CartItem.cart_id == cart.id).one()
+        totals = CartTotals(cart.id, cart.version, (Decimal(cents) / 100).quantize(Decimal('0.01')), int(items_count))
+        _totals_cache.set(key, totals)
+    return totals
+
+
+def get_cart_lines(db, cart_id):
+    # Позиции корзины для шаблонов без загрузки ORM-объектов; структура
+    # повторяет item.product.category.name, которое используют шаблоны.
+    # stock_quantity здесь — сколько товара доступно этой корзине с учётом
+    # резервов других покупателей.
+    if cart_id is None:
+        return []
+    rows = db.query(
+        CartItem.id, CartItem.quantity,
+        Product.id.label('product_id'), Product.name, Product.price,
+        Product.image_url, available_for_cart(cart_id).label('stock_quantity'),
+        Category.name.label('category_name'),
+        (_PRICE_CENTS * CartItem.quantity).label('line_cents')
+    ).join(Product, Product.id == CartItem.product_id).outerjoin(
+        Category, Category.id == Product.category_id
+    ).filter(CartItem.cart_id == cart_id).order_by(CartItem.id).all()
+
+    return [
+        {
+            'id': row.id,
+            'quantity': row.quantity,
+            'line_total': (Decimal(row.line_cents) / 100).quantize(Decimal('0.01')),
+            'product': {
+                'id': row.product_id,
+                'name': row.name,
+                'price': Decimal(str(row.price)),
+                'image_url': row.image_url or '',
+                'stock_quantity': row.stock_quantity,
+                'category': {'name': row.category_name}
+            }
+        }
+        for row in rows
+    ]
@@ -0,0 +1,217 @@
+import csv
+import io
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from sqlalchemy import case, func
+from sqlalchemy.dialects.sqlite import insert
+from .__all_models import Product, Category
+from .cart import touch_carts
+
+EXPORT_FIELDS = ['sku', 'name', 'description', 'price', 'stock_quantity', 'category', 'image_url']
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+
+def detect_format(filename, default='csv'):
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if filename and filename.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_rows(stream, fmt):
+    # Построчно читает CSV или JSONL из бинарного потока и отдаёт пары
+    # (номер строки, словарь полей); файл целиком в память не загружается
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(text_stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f'Некорректный JSON: {e}')
+                continue
+            yield line_number, row if isinstance(row, dict) else ValueError('Ожидается JSON-объект')
+    else:
+        reader = csv.DictReader(text_stream)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def validate_row(row):
+    if isinstance(row, Exception):
+        raise row
+
+    sku = str(row.get('sku') or '').strip()
+    name = str(row.get('name') or '').strip()
+    category = str(row.get('category') or '').strip()
+    if not sku:
+        raise ValueError('Не указан sku')
+    if not name:
+        raise ValueError('Не указано название')
+    if not category:
+        raise ValueError('Не указана категория')
+
+    # NaN, Infinity и слишком большие числа тоже ошибка строки: сравнение и
+    # quantize на них бросают InvalidOperation
+    try:
+        price = Decimal(str(row.get('price')).replace(',', '.'))
+        if not price.is_finite():
+            raise ValueError('Некорректная цена')
+        if price <= 0:
+            raise ValueError('Цена должна быть больше нуля')
+        price = price.quantize(Decimal('0.01'))
+    except (InvalidOperation, TypeError):
+        raise ValueError('Некорректная цена')
+
+    # Отсутствующий или пустой остаток — None, как и отсутствующие описание и
+    # картинка: у существующего товара эти поля не меняются. Пустое значение
+    # картинки убирает её
+    stock_quantity = row.get('stock_quantity')
+    if stock_quantity is not None and str(stock_quantity).strip() == '':
+        stock_quantity = None
+    if stock_quantity is not None:
+        try:
+            stock_quantity = int(stock_quantity)
+        except (TypeError, ValueError):
+            raise ValueError('Некорректный остаток')
+        if stock_quantity < 0:
+            raise ValueError('Остаток не может быть отрицательным')
+
+    description = row.get('description')
+    image_url = row.get('image_url')
+    return {
+        'sku': sku[:64],
+        'name': name[:255],
+        'description': str(description) if description is not None else None,
+        'price': price,
+        'stock_quantity': stock_quantity,
+        'category': category[:100],
+        'image_url': str(image_url).strip()[:255] if image_url is not None else None
+    }
+
+
+def _resolve_categories(db, category_ids, names):
+    missing = [name for name in names if name not in category_ids]
+    if missing:
+        db.execute(insert(Category).on_conflict_do_nothing(index_elements=[Category.name]),
+                   [{'name': name} for name in missing])
+        category_ids.update(db.query(Category.name, Category.id).filter(Category.name.in_(missing)))
+
+
+def _upsert_batch(db, category_ids, batch):
+    _resolve_categories(db, category_ids, {row['category'] for row in batch})
+    skus = [row['sku'] for row in batch]
+    existing = dict(db.query(Product.sku, Product.id).filter(Product.sku.in_(skus)))
+
+    # Core-вставка: ORM при пачечной вставке пропускает ключи со значением
+    # None и подставляет значения по умолчанию, а None здесь означает «не менять»
+    table = Product.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.sku],
+        set_={
+            'name': statement.excluded.name,
+            'description': func.coalesce(statement.excluded.description, table.c.description),
+            'price': statement.excluded.price,
+            'stock_quantity': func.coalesce(statement.excluded.stock_quantity, table.c.stock_quantity),
+            'category_id': statement.excluded.category_id,
+            'image_url': case(
+                (statement.excluded.image_url.is_(None), table.c.image_url),
+                else_=func.nullif(statement.excluded.image_url, '')
+            )
+        }
+    )
+    db.execute(statement, [
+        {
+            'sku': row['sku'],
+            'name': row['name'],
+            'description': row['description'] if row['sku'] in existing else row['description'] or '',
+            'price': row['price'],
+            'stock_quantity': row['stock_quantity'] if row['sku'] in existing else row['stock_quantity'] or 0,
+            'category_id': category_ids[row['category']],
+            'image_url': row['image_url'] if row['sku'] in existing else row['image_url'] or None
+        }
+        for row in batch
+    ])
+
+    if existing:
+        # Цены могли измениться: сбрасываем закэшированные итоги корзин
+        touch_carts(db, product_ids=list(existing.values()))
+
+    created = len({row['sku'] for row in batch} - existing.keys())
+    return created, len(batch) - created
+
+
+def import_products(db, rows, batch_size=IMPORT_BATCH_SIZE):
+    # Импортирует товары пачками по batch_size, каждая пачка в своей
+    # транзакции; строки с ошибками пропускаются и попадают в отчёт
+    report = {'created': 0, 'updated': 0, 'errors': [], 'error_count': 0}
+    category_ids = dict(db.query(Category.name, Category.id))
+    rows = iter(rows)
+
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+
+        batch = {}
+        for line_number, row in chunk:
+            try:
+                valid = validate_row(row)
+            except ValueError as e:
+                report['error_count'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append({'line': line_number, 'error': str(e)})
+                continue
+            # Повтор sku внутри пачки: побеждает последняя строка
+            batch[valid['sku']] = valid
+
+        if not batch:
+            continue
+        try:
+            created, updated = _upsert_batch(db, category_ids, list(batch.values()))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            category_ids = dict(db.query(Category.name, Category.id))
+            report['error_count'] += len(batch)
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append({
+                    'line': chunk[0][0],
+                    'error': f'Пачка строк {chunk[0][0]}-{chunk[-1][0]} не загружена: {e}'
+                })
+            continue
+        report['created'] += created
+        report['updated'] += updated
+
+    return report
+
+
+def iter_export(db, fmt, batch_size=IMPORT_BATCH_SIZE):
+    # Генератор для потоковой выгрузки: строки читаются из базы пачками
+    query = db.query(
+        Product.sku, Product.name, Product.description, Product.price,
+        Product.stock_quantity, Category.name.label('category'), Product.image_url
+    ).outerjoin(Category, Category.id == Product.category_id).order_by(Product.id).yield_per(batch_size)
+
+    if fmt == 'jsonl':
+        for row in query:
+            data = row._asdict()
+            data['price'] = str(data['price'])
+            yield json.dumps(data, ensure_ascii=False) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for index, row in enumerate(query, start=1):
+        writer.writerow(row)
+        if index % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,121 @@
+from decimal import Decimal
+from sqlalchemy import insert, update, bindparam
+from .__all_models import Product, Cart, CartItem, Order, OrderItem, DeliveryAddress
+from .cart import get_cart_totals, touch_carts
+from .promo import evaluate_promo, activate_promo, apply_discount, PromoError
+from .reservations import available_for_cart, own_reserved, release_cart
+from .analytics import RECORD_ORDER_TASK
+from .jobs import enqueue
+from .timeutils import utcnow
+
+
+class CheckoutError(Exception):
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.message = message
+        self.reason = reason
+
+
+def load_cart_lines(db, user_id):
+    cart = db.query(Cart).filter_by(user_id=user_id).first()
+    if not cart:
+        return None, []
+    lines = db.query(
+        CartItem.product_id, CartItem.quantity, Product.name, Product.price,
+        available_for_cart(cart.id).label('available')
+    ).join(Product, Product.id == CartItem.product_id).filter(CartItem.cart_id == cart.id).all()
+    return cart, lines
+
+
+def reserve_stock(db, cart_id, lines):
+    # Одним executemany списывает остатки; строка, для которой остатка не
+    # хватает, не обновится, и тогда весь заказ откатывается вызывающим кодом.
+    # Резерв самой корзины считается доступным ей остатком.
+    table = Product.__table__
+    statement = update(table).where(
+        table.c.id == bindparam('line_product_id'),
+        table.c.stock_quantity - table.c.reserved_quantity
+        + own_reserved(cart_id, table.c.id) >= bindparam('line_quantity')
+    ).values(stock_quantity=table.c.stock_quantity - bindparam('line_quantity'))
+    result = db.execute(statement, [
+        {'line_product_id': line.product_id, 'line_quantity': line.quantity}
+        for line in lines
+    ])
+    if result.rowcount == len(lines):
+        release_cart(db, cart_id)
+        return
+
+    stock = dict(db.query(Product.id, available_for_cart(cart_id)).filter(
+        Product.id.in_([line.product_id for line in lines])
+    ))
+    for line in lines:
+        available = stock.get(line.product_id) or 0
+        if available < line.quantity:
+            raise CheckoutError(
+                f'Недостаточно товара "{line.name}". Доступно: {max(available, 0)}',
+                'out_of_stock'
+            )
+    raise CheckoutError('Не удалось зарезервировать товары', 'out_of_stock')
+
+
+def place_order(db, user, address, promo_code=''):
+    # Оформляет заказ в текущей транзакции сессии; фиксирует её вызывающий код.
+    # Возвращает заказ и список предупреждений по промокоду.
+    cart, lines = load_cart_lines(db, user.id)
+    if not lines:
+        raise CheckoutError('Корзина пуста', 'empty_cart')
+
+    for line in lines:
+        if line.available < line.quantity:
+            raise CheckoutError(
+                f'Недостаточно товара "{line.name}". Доступно: {max(line.available, 0)}',
+                'out_of_stock'
+            )
+
+    total = get_cart_totals(db, user.id).subtotal
+    total_with_discount = total
+    warnings = []
+    promo = None
+
+    if promo_code:
+        try:
+            promo = evaluate_promo(db, promo_code, user.id, total)
+            promo = activate_promo(db, promo)
+            total_with_discount = apply_discount(total, promo)
+        except PromoError as e:
+            warnings.append((e.message, f'promo_{e.reason}'))
+            promo = None
+
+    reserve_stock(db, cart.id, lines)
+
+    order = Order(
+        user_id=user.id,
+        total_amount=total_with_discount.quantize(Decimal('0.01')),
+        status='Ожидает оплаты',
+        promo_code=promo.code if promo else None,
+        created_at=utcnow()
+    )
+    db.add(order)
+    db.flush()
+
+    db.execute(insert(OrderItem), [
+        {
+            'order_id': order.id,
+            'product_id': line.product_id,
+            'quantity': line.quantity,
+            'price_at_purchase': line.price
+        }
+        for line in lines
+    ])
+
+    db.add(DeliveryAddress(
+        order_id=order.id,
+        phone=user.phone,
+        **address
+    ))
+
+    enqueue(db, RECORD_ORDER_TASK, key=f'order-analytics:{order.id}', order_id=order.id)
+
+    db.query(CartItem).filter_by(cart_id=cart.id).delete(synchronize_session=False)
+    touch_carts(db, cart_id=cart.id)
+    return order, warnings
@@ -1,44 +1,135 @@
-from sqlalchemy import create_engine
+import logging
+import os
+import threading
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from flask import g
 from .__all_models import Base
-from sqlalchemy.types import DateTime
-import pytz
-from datetime import datetime
+from .search import create_search_index
+from .migrations import upgrade, get_schema_version, SCHEMA_VERSION
+from .metrics import InstrumentedQueuePool
 
-DATABASE_URL = "sqlite:///db/shop.db"
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///db/shop.db')
 
-Base.metadata.create_all(bind=engine)
+# Применяются к каждому новому соединению SQLite. WAL позволяет читателям
+# не блокировать писателя, busy_timeout заставляет ждать блокировку вместо
+# немедленной ошибки "database is locked".
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('DB_BUSY_TIMEOUT', 5000)),
+    'cache_size': int(os.environ.get('DB_CACHE_SIZE', -20000)),
+    'mmap_size': int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024)),
+}
 
+logger = logging.getLogger('shop.db')
 
-def moscow_datetime():
-    return datetime.now(pytz.timezone('Europe/Moscow'))
+engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
 
 
-def setup_sqlite():
-    engine = create_engine(DATABASE_URL)
+def _env_flag(name):
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
 
-    def moscow_date_processor(dt):
-        return dt.astimezone(pytz.timezone('Europe/Moscow')).isoformat()
 
-    DateTime.ResultProcessor = type(
-        'DateTimeMoscow',
-        (DateTime.ResultProcessor,),
-        {'process': lambda self, value: moscow_date_processor(value)}
-    )
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+    finally:
+        cursor.close()
+
+
+def create_db_engine(database_url=None, echo=None, pool_size=None, max_overflow=None):
+    database_url = database_url or DATABASE_URL
+    if echo is None:
+        echo = _env_flag('DB_ECHO')
+
+    if not database_url.startswith('sqlite'):
+        return create_engine(database_url, echo=echo)
+
+    if database_url in ('sqlite://', 'sqlite:///:memory:'):
+        # In-memory база живёт только в одном соединении
+        db_engine = create_engine(
+            database_url,
+            echo=echo,
+            poolclass=StaticPool,
+            connect_args={'check_same_thread': False}
+        )
+    else:
+        # Каждый поток получает из пула своё соединение на время запроса
+        db_engine = create_engine(
+            database_url,
+            echo=echo,
+            poolclass=InstrumentedQueuePool,
+            pool_size=pool_size or int(os.environ.get('DB_POOL_SIZE', 5)),
+            max_overflow=max_overflow if max_overflow is not None else int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            connect_args={'check_same_thread': False}
+        )
+    event.listen(db_engine, 'connect', _set_sqlite_pragmas)
+    return db_engine
+
+
+def init_db(db_engine=None):
+    # Создаёт недостающие таблицы, применяет миграции и поисковый индекс.
+    # Возвращает названия применённых миграций.
+    db_engine = db_engine or get_engine(check_schema=False)
+    Base.metadata.create_all(db_engine)
+    applied = upgrade(db_engine)
+    create_search_index(db_engine)
+    return applied
+
+
+def _check_schema(db_engine):
+    # Схема создаётся и обновляется командой flask migrate, а не при запуске
+    # приложения; DB_AUTO_MIGRATE=1 обновляет её при первом подключении
+    # (для in-memory баз и локальной разработки)
+    if _env_flag('DB_AUTO_MIGRATE'):
+        init_db(db_engine)
+    elif db_engine.dialect.name == 'sqlite':
+        with db_engine.connect() as connection:
+            if get_schema_version(connection) < SCHEMA_VERSION:
+                logger.warning('Схема базы данных устарела, выполните flask migrate')
+
+
+def get_engine(check_schema=True):
+    # Движок создаётся при первом обращении к базе, а не при импорте модуля
+    global engine
+    if engine is None:
+        with _engine_lock:
+            if engine is None:
+                db_engine = create_db_engine()
+                if check_schema:
+                    _check_schema(db_engine)
+                engine = db_engine
+    return engine
 
 
-def global_init(db_file: str = 'db/shop.db'):
-    global SessionLocal
-    DATABASE_URL = f"sqlite:///{db_file}"
-    engine = create_engine(DATABASE_URL, echo=True)
-    Base.metadata.create_all(engine)
-    SessionLocal = sessionmaker(bind=engine)
+def SessionLocal():
+    return _session_factory(bind=get_engine())
+
+
+def global_init(db_file: str = None, echo: bool = None):
+    # Явная инициализация для скриптов: движок для указанной базы и схема
+    global engine
+    database_url = f"sqlite:///{db_file}" if db_file else DATABASE_URL
+    with _engine_lock:
+        if engine is not None:
+            engine.dispose()
+        engine = create_db_engine(database_url, echo=echo)
+    init_db(engine)
     return SessionLocal
 
 
-Session = global_init()
+def reset_after_fork():
+    # Соединения пула, унаследованные от родительского процесса, в дочернем
+    # использовать нельзя: пул забывает их, не закрывая (они остаются
+    # родителю), и открывает свои
+    if engine is not None:
+        engine.dispose(close=False)
 
 
 def get_db():
@@ -47,3 +138,31 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def get_session():
+    # Одна сессия на контекст приложения: открывается при первом обращении,
+    # закрывается в close_session()
+    if 'db' not in g:
+        g.db = SessionLocal()
+    return g.db
+
+
+def close_session(exception=None):
+    db = g.pop('db', None)
+    if db is None:
+        return
+    try:
+        if exception is None:
+            db.commit()
+        else:
+            db.rollback()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def init_app(app):
+    app.teardown_appcontext(close_session)
@@ -0,0 +1,35 @@
+import os
+from jinja2 import nodes
+from jinja2.ext import Extension
+from .cache import LRUCache
+
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 5000))
+
+# Отрендеренные фрагменты шаблонов внутри процесса. Ключ задаётся в шаблоне и
+# должен включать всё, от чего зависит разметка (для карточки — id и версию
+# товара; версия берётся из общего счётчика каталога и не повторяется даже
+# при повторном использовании id), поэтому устаревшие записи не
+# сбрасываются, а вытесняются.
+fragment_cache = LRUCache(maxsize=FRAGMENT_CACHE_SIZE)
+
+
+class FragmentCacheExtension(Extension):
+    # {% cache 'product_card', product.id, product.version %} ... {% endcache %}
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.Tuple(parts, 'load')]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        html = fragment_cache.get(key)
+        if html is None:
+            html = caller()
+            fragment_cache.set(key, html)
+        return html
@@ -0,0 +1,106 @@
+import hashlib
+import io
+import logging
+import os
+import re
+from flask import url_for
+
+logger = logging.getLogger('shop.images')
+
+# Размеры вариантов: миниатюра в корзине, карточка в каталоге и страница
+# товара. Размеры взяты с запасом в 2 раза под экраны с высокой плотностью.
+IMAGE_SIZES = {
+    'thumb': (160, 160),
+    'card': (640, 500),
+    'large': (1000, 1000),
+}
+IMAGE_FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'png': {'format': 'PNG', 'optimize': True},
+}
+KEY_LENGTH = 20
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+_KEY_RE = re.compile(rf'[0-9a-f]{{{KEY_LENGTH}}}')
+
+
+def is_image_key(value):
+    return bool(value) and _KEY_RE.fullmatch(value) is not None
+
+
+def variant_name(key, size, fmt):
+    return f'{key}-{size}.{fmt}'
+
+
+def product_image_url(value, size='card', fmt='png'):
+    if not value:
+        return url_for('static', filename='img/placeholder.png')
+    if is_image_key(value):
+        return url_for('product_image', filename=variant_name(value, size, fmt))
+    if '/' in value or ':' in value:
+        return value
+    return url_for('static', filename='img/products/' + value)
+
+
+def _render_variant(image, size):
+    from PIL import Image, ImageOps
+    width, height = IMAGE_SIZES[size]
+    if size == 'thumb':
+        return ImageOps.fit(image, (width, height), Image.LANCZOS)
+    if image.width <= width and image.height <= height:
+        return image
+    return ImageOps.contain(image, (width, height), Image.LANCZOS)
+
+
+def save_image(stream, folder):
+    # Сохраняет все варианты загруженного изображения под именем из хэша
+    # содержимого и возвращает этот ключ. Одинаковые файлы не пересохраняются.
+    data = stream.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise ValueError('Изображение больше 10 МБ')
+
+    key = hashlib.sha256(data).hexdigest()[:KEY_LENGTH]
+    if all(os.path.exists(os.path.join(folder, variant_name(key, size, fmt)))
+           for size in IMAGE_SIZES for fmt in IMAGE_FORMATS):
+        return key
+
+    # Pillow нужен только при загрузке изображений и не импортируется при старте
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+            image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        raise ValueError('Файл не является изображением')
+
+    image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    os.makedirs(folder, exist_ok=True)
+    for size in IMAGE_SIZES:
+        variant = _render_variant(image, size)
+        for fmt, options in IMAGE_FORMATS.items():
+            path = os.path.join(folder, variant_name(key, size, fmt))
+            # Пишем во временный файл и переименовываем, чтобы параллельный
+            # запрос не отдал наполовину записанную картинку
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            variant.save(tmp_path, **options)
+            os.replace(tmp_path, path)
+    return key
+
+
+def remove_image(folder, image_url):
+    if is_image_key(image_url):
+        paths = [os.path.join(folder, variant_name(image_url, size, fmt))
+                 for size in IMAGE_SIZES for fmt in IMAGE_FORMATS]
+    elif image_url and image_url.startswith('/static/'):
+        # Старые записи хранили путь к загруженному файлу целиком
+        paths = [os.path.join(folder, os.path.basename(image_url))]
+    else:
+        return
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception('Не удалось удалить изображение %s', path)
@@ -0,0 +1,226 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from datetime import timedelta
+from sqlalchemy import select, update, delete, event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from .__all_models import Job
+from .timeutils import utcnow
+
+# Очередь фоновых задач в той же базе SQLite. Задача ставится в очередь в
+# транзакции, которая её порождает (enqueue до commit), поэтому не теряется
+# и не выполняется для откатившихся изменений. Обработчик работает в своей
+# сессии, и отметка о выполнении фиксируется в той же транзакции, что и его
+# изменения в базе: для них задача выполняется ровно один раз, а действия
+# вне базы (удаление файлов) должны быть идемпотентными.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 300))
+KEEP_FINISHED_DAYS = int(os.environ.get('JOB_KEEP_DAYS', 7))
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 3600
+HOUSEKEEPING_INTERVAL = 60
+
+logger = logging.getLogger('shop.jobs')
+
+TASKS = {}
+_wakeup = threading.Event()
+
+
+def task(name, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    def decorator(handler):
+        TASKS[name] = (handler, max_attempts)
+        return handler
+
+    return decorator
+
+
+def enqueue(db, name, key=None, delay=0, **payload):
+    # Повторная постановка с тем же key игнорируется
+    now = utcnow()
+    db.execute(insert(Job.__table__).values(
+        name=name,
+        payload=json.dumps(payload, ensure_ascii=False),
+        idempotency_key=key,
+        status='queued',
+        attempts=0,
+        run_after=now + timedelta(seconds=delay),
+        created_at=now
+    ).on_conflict_do_nothing(index_elements=['idempotency_key']))
+    db.info['jobs_enqueued'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_workers(db):
+    if db.info.pop('jobs_enqueued', False):
+        _wakeup.set()
+
+
+def claim(db, worker_id, limit=1):
+    # Забирает задачи одним UPDATE ... RETURNING: две параллельные выборки не
+    # получат одну и ту же задачу
+    now = utcnow()
+    jobs = db.execute(
+        update(Job).where(Job.id.in_(
+            select(Job.id).where(Job.status == 'queued', Job.run_after <= now)
+            .order_by(Job.run_after, Job.id).limit(limit)
+        )).values(
+            status='running', locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1
+        ).returning(Job.id, Job.name, Job.payload, Job.attempts).execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return jobs
+
+
+def _finish(db, job, worker_id, status, error=None, delay=0):
+    # Условие по locked_by не даёт отметить задачу, которую за время работы
+    # вернули в очередь как зависшую и отдали другому обработчику
+    now = utcnow()
+    return db.execute(
+        update(Job).where(
+            Job.id == job.id, Job.status == 'running', Job.locked_by == worker_id
+        ).values(
+            status=status,
+            last_error=error,
+            run_after=now + timedelta(seconds=delay),
+            finished_at=now if status in ('done', 'failed') else None,
+            locked_by=None,
+            locked_at=None
+        ).execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def run_job(session_factory, worker_id, job):
+    handler, max_attempts = TASKS.get(job.name, (None, 1))
+    db = session_factory()
+    try:
+        try:
+            if handler is None:
+                raise LookupError(f'Неизвестная задача {job.name}')
+            handler(db, **json.loads(job.payload))
+            if _finish(db, job, worker_id, 'done'):
+                db.commit()
+                return True
+            db.rollback()
+            return False
+        except Exception:
+            db.rollback()
+            error = traceback.format_exc(limit=5)
+            logger.warning('Задача %s #%s завершилась ошибкой (попытка %s)', job.name, job.id, job.attempts,
+                           exc_info=True)
+            if job.attempts < max_attempts:
+                delay = min(RETRY_BASE_DELAY * 2 ** (job.attempts - 1), RETRY_MAX_DELAY)
+                _finish(db, job, worker_id, 'queued', error=error, delay=delay)
+            else:
+                _finish(db, job, worker_id, 'failed', error=error)
+            db.commit()
+            return False
+    finally:
+        db.close()
+
+
+def run_pending(session_factory, worker_id=None, limit=None):
+    # Выполняет готовые задачи, пока они есть (или пока не выполнено limit)
+    worker_id = worker_id or default_worker_id()
+    processed = 0
+    while limit is None or processed < limit:
+        db = session_factory()
+        try:
+            jobs = claim(db, worker_id)
+        finally:
+            db.close()
+        if not jobs:
+            break
+        for job in jobs:
+            run_job(session_factory, worker_id, job)
+            processed += 1
+    return processed
+
+
+def housekeeping(db):
+    # Возвращает в очередь задачи упавших обработчиков и удаляет старые
+    # выполненные задачи
+    now = utcnow()
+    db.execute(update(Job).where(
+        Job.status == 'running', Job.locked_at < now - timedelta(seconds=STALE_AFTER)
+    ).values(status='queued', locked_by=None, locked_at=None).execution_options(synchronize_session=False))
+    db.execute(delete(Job).where(
+        Job.status == 'done', Job.finished_at < now - timedelta(days=KEEP_FINISHED_DAYS)
+    ))
+    db.commit()
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+
+
+def work(session_factory, stop, poll_interval=POLL_INTERVAL):
+    worker_id = default_worker_id()
+    last_housekeeping = None
+    while not stop.is_set():
+        try:
+            now = utcnow()
+            if last_housekeeping is None or (now - last_housekeeping).total_seconds() >= HOUSEKEEPING_INTERVAL:
+                db = session_factory()
+                try:
+                    housekeeping(db)
+                finally:
+                    db.close()
+                last_housekeeping = now
+            if run_pending(session_factory, worker_id):
+                continue
+        except Exception:
+            logger.exception('Ошибка обработчика очереди задач')
+        _wakeup.wait(poll_interval)
+        _wakeup.clear()
+
+
+def start_workers(session_factory, count=JOB_WORKERS):
+    # Потоки-обработчики внутри процесса приложения
+    stop = threading.Event()
+    for index in range(count):
+        threading.Thread(
+            target=work, args=(session_factory, stop), name=f'job-worker-{index}', daemon=True
+        ).start()
+    return stop
+
+
+def _process_main(session_factory, after_fork):
+    after_fork()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: (stop.set(), _wakeup.set()))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    work(session_factory, stop)
+
+
+def run_worker_processes(session_factory, processes, after_fork):
+    # Отдельные процессы-обработчики (flask run-jobs). after_fork вызывается
+    # в каждом дочернем процессе, чтобы он открыл собственные соединения
+    context = multiprocessing.get_context('fork')
+    workers = [
+        context.Process(target=_process_main, args=(session_factory, after_fork), name=f'job-worker-{index}')
+        for index in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.join()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        # Дочерние процессы дорабатывают текущую задачу и выходят
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
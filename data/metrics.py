@@ -0,0 +1,234 @@
+import math
+import os
+import threading
+import time
+from flask import g, request, Response, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
+class _Shard:
+    # Значения одного потока. Пишет в шард только его поток, поэтому запись
+    # идёт без блокировок; при экспорте шарды суммируются.
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}
+        self.histograms = {}
+
+
+class Registry:
+    def __init__(self):
+        self._meta = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        # Сюда сливаются значения завершившихся потоков
+        self._retired = _Shard(None)
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, tuple(buckets or DEFAULT_BUCKETS) if kind == 'histogram' else None)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard().counters
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        histograms = self._shard().histograms
+        key = (name, tuple(sorted(labels.items())))
+        histogram = histograms.get(key)
+        if histogram is None:
+            buckets = self._meta[name][2]
+            histogram = histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+        buckets = self._meta[name][2]
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        histogram[0][index] += 1
+        histogram[1] += value
+
+    @staticmethod
+    def _merge(target, counters, histograms):
+        for key, value in counters.items():
+            target.counters[key] = target.counters.get(key, 0) + value
+        for key, (counts, total) in histograms.items():
+            merged = target.histograms.get(key)
+            if merged is None:
+                merged = target.histograms[key] = [[0] * len(counts), 0.0]
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+
+    def collect(self):
+        # Копии словарей делаются без блокировки шардов: dict.copy() атомарен
+        # под GIL, а небольшая рассинхронизация между метриками допустима
+        with self._lock:
+            alive = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    alive.append(shard)
+                else:
+                    self._merge(self._retired, shard.counters, shard.histograms)
+            self._shards = alive
+            result = _Shard(None)
+            self._merge(result, self._retired.counters.copy(), self._retired.histograms.copy())
+            for shard in alive:
+                self._merge(result, shard.counters.copy(), shard.histograms.copy())
+        return result
+
+    def render(self, gauges=()):
+        collected = self.collect()
+        lines = []
+        by_name = {}
+        for (name, labels), value in collected.counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), value in collected.histograms.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name, labels, value in gauges:
+            by_name.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+
+        for name in sorted(by_name):
+            kind, help_text, buckets = self._meta[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(buckets + (math.inf,), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else _format_value(bound)
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+registry.describe('shop_http_requests_total', 'counter', 'HTTP requests by endpoint, method and status')
+registry.describe('shop_http_request_duration_seconds', 'histogram', 'HTTP request latency by endpoint')
+registry.describe('shop_http_requests_in_flight', 'gauge', 'HTTP requests being processed')
+registry.describe('shop_db_queries_total', 'counter', 'SQL statements executed')
+registry.describe('shop_db_pool_checkouts_total', 'counter', 'Connections checked out of the pool')
+registry.describe('shop_db_pool_wait_seconds', 'histogram', 'Time spent waiting for a pooled connection',
+                  buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+registry.describe('shop_db_pool_size', 'gauge', 'Configured pool size')
+registry.describe('shop_db_pool_checked_out', 'gauge', 'Connections currently checked out')
+registry.describe('shop_db_pool_overflow', 'gauge', 'Connections opened above the pool size')
+registry.describe('shop_orders_created_total', 'counter', 'Orders created')
+registry.describe('shop_promo_activations_total', 'counter', 'Promo code activations')
+registry.describe('shop_checkout_failures_total', 'counter', 'Failed or degraded checkouts by reason')
+
+
+class InstrumentedQueuePool(QueuePool):
+    # QueuePool, который замеряет ожидание свободного соединения
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            registry.observe('shop_db_pool_wait_seconds', time.perf_counter() - started)
+
+
+def record_checkout(order=None, warnings=(), failure=None):
+    if failure:
+        registry.inc('shop_checkout_failures_total', reason=failure)
+        return
+    registry.inc('shop_orders_created_total')
+    if order is not None and order.promo_code:
+        registry.inc('shop_promo_activations_total')
+    for _, reason in warnings:
+        registry.inc('shop_checkout_failures_total', reason=reason)
+
+
+def _count_query(*args):
+    registry.inc('shop_db_queries_total')
+
+
+def _count_checkout(*args):
+    registry.inc('shop_db_pool_checkouts_total')
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    registry.inc('shop_http_requests_in_flight')
+
+
+def _record_request(status):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    endpoint = request.endpoint or 'unknown'
+    registry.observe('shop_http_request_duration_seconds', time.perf_counter() - started,
+                     endpoint=endpoint, method=request.method)
+    registry.inc('shop_http_requests_total', endpoint=endpoint, method=request.method, status=str(status))
+
+
+def _finish_request(response):
+    _record_request(response.status_code)
+    return response
+
+
+def _teardown_request(exception):
+    # Если after_request не вызывался (необработанное исключение), запрос
+    # учитывается как 500
+    _record_request(500)
+    if 'metrics_in_flight_done' not in g:
+        g.metrics_in_flight_done = True
+        registry.inc('shop_http_requests_in_flight', -1)
+
+
+def pool_gauges(db_engine):
+    pool = db_engine.pool if db_engine is not None else None
+    if not isinstance(pool, QueuePool):
+        return []
+    return [
+        ('shop_db_pool_size', {}, pool.size()),
+        ('shop_db_pool_checked_out', {}, pool.checkedout()),
+        ('shop_db_pool_overflow', {}, max(pool.overflow(), 0)),
+    ]
+
+
+def init_metrics(app, get_engine):
+    if not event.contains(Engine, 'after_cursor_execute', _count_query):
+        event.listen(Engine, 'after_cursor_execute', _count_query)
+        event.listen(QueuePool, 'checkout', _count_checkout)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+
+    @app.route('/metrics')
+    def metrics():
+        if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            abort(401)
+        return Response(
+            registry.render(pool_gauges(get_engine())),
+            content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
@@ -0,0 +1,266 @@
+from sqlalchemy import text
+from .analytics import rebuild_analytics
+
+# create_all() создаёт только отсутствующие таблицы и не меняет уже
+# существующие, поэтому изменения схемы для старых баз (db/shop.db)
+# выполняются здесь. Номер применённой миграции хранится в PRAGMA user_version.
+
+
+def _hot_path_indexes(connection):
+    # Перед созданием уникального индекса сливаем дубли строк корзины
+    connection.execute(text("""
+        UPDATE cart_items SET quantity = (
+            SELECT sum(duplicate.quantity) FROM cart_items AS duplicate
+            WHERE duplicate.cart_id IS cart_items.cart_id
+              AND duplicate.product_id IS cart_items.product_id
+        )
+        WHERE id IN (
+            SELECT min(id) FROM cart_items
+            GROUP BY cart_id, product_id HAVING count(*) > 1
+        )
+    """))
+    connection.execute(text("""
+        DELETE FROM cart_items WHERE id NOT IN (
+            SELECT min(id) FROM cart_items GROUP BY cart_id, product_id
+        )
+    """))
+
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_carts_user_id ON carts (user_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_items_cart_product ON cart_items (cart_id, product_id)",
+        "CREATE INDEX IF NOT EXISTS ix_cart_items_product_id ON cart_items (product_id)",
+        "CREATE INDEX IF NOT EXISTS ix_orders_user_id_promo_code ON orders (user_id, promo_code)",
+        "CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON order_items (order_id)",
+        "CREATE INDEX IF NOT EXISTS ix_products_category_id ON products (category_id)",
+    ):
+        connection.execute(text(statement))
+
+
+def _unique_cart_per_user(connection):
+    # Сливаем все корзины пользователя в самую раннюю, суммируя одинаковые
+    # позиции, и удаляем лишние корзины
+    connection.execute(text("""
+        CREATE TEMP TABLE cart_merge AS
+        SELECT carts.id AS cart_id, keep.keep_id AS keep_id
+        FROM carts JOIN (
+            SELECT user_id, min(id) AS keep_id FROM carts
+            WHERE user_id IS NOT NULL GROUP BY user_id HAVING count(*) > 1
+        ) AS keep ON keep.user_id = carts.user_id
+    """))
+    connection.execute(text("""
+        CREATE TEMP TABLE cart_items_merged AS
+        SELECT min(cart_items.id) AS id, sum(cart_items.quantity) AS quantity,
+               cart_merge.keep_id AS cart_id, cart_items.product_id AS product_id
+        FROM cart_items JOIN cart_merge ON cart_merge.cart_id = cart_items.cart_id
+        GROUP BY cart_merge.keep_id, cart_items.product_id
+    """))
+    connection.execute(text("DELETE FROM cart_items WHERE cart_id IN (SELECT cart_id FROM cart_merge)"))
+    connection.execute(text("""
+        INSERT INTO cart_items (id, quantity, cart_id, product_id)
+        SELECT id, quantity, cart_id, product_id FROM cart_items_merged
+    """))
+    connection.execute(text("""
+        DELETE FROM carts WHERE id IN (
+            SELECT cart_id FROM cart_merge WHERE cart_id <> keep_id
+        )
+    """))
+    connection.execute(text("DROP TABLE cart_items_merged"))
+    connection.execute(text("DROP TABLE cart_merge"))
+
+    connection.execute(text("DROP INDEX IF EXISTS ix_carts_user_id"))
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_carts_user_id ON carts (user_id)"))
+
+
+def _cart_version(connection):
+    columns = [row[1] for row in connection.execute(text("PRAGMA table_info(carts)"))]
+    if 'version' not in columns:
+        connection.execute(text("ALTER TABLE carts ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+
+def _order_history_index(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_orders_user_id_created_at ON orders (user_id, created_at)"
+    ))
+
+
+def _product_name_index(connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_products_name ON products (name)"))
+
+
+def _product_sku(connection):
+    columns = [row[1] for row in connection.execute(text("PRAGMA table_info(products)"))]
+    if 'sku' not in columns:
+        connection.execute(text("ALTER TABLE products ADD COLUMN sku VARCHAR(64)"))
+    connection.execute(text("UPDATE products SET sku = printf('P%06d', id) WHERE sku IS NULL"))
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_products_sku ON products (sku)"))
+
+
+def _catalog_version(connection):
+    # Счётчик версий каталога для ETag и кэшей: его увеличивают триггеры при
+    # любом изменении товаров (включая остатки) и категорий, кто бы ни писал
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS catalog_version ("
+        "id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)"
+    ))
+    connection.execute(text("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)"))
+    for name, event in (
+        ('products_version_insert', 'AFTER INSERT ON products'),
+        ('products_version_delete', 'AFTER DELETE ON products'),
+        ('products_version_update', 'AFTER UPDATE OF sku, name, description, price, stock_quantity, '
+                                    'category_id, image_url ON products'),
+        ('categories_version_insert', 'AFTER INSERT ON categories'),
+        ('categories_version_delete', 'AFTER DELETE ON categories'),
+        ('categories_version_update', 'AFTER UPDATE ON categories'),
+    ):
+        connection.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN "
+            f"UPDATE catalog_version SET version = version + 1 WHERE id = 1; END"
+        ))
+
+
+def _stock_reservations(connection):
+    # Таблицу stock_reservations создаёт create_all(); существующие позиции
+    # корзин остаются без резерва и проверяются по остатку при оформлении
+    columns = [row[1] for row in connection.execute(text("PRAGMA table_info(products)"))]
+    if 'reserved_quantity' not in columns:
+        connection.execute(text("ALTER TABLE products ADD COLUMN reserved_quantity INTEGER NOT NULL DEFAULT 0"))
+
+
+def _sales_analytics(connection):
+    rebuild_analytics(connection)
+
+
+def _product_row_version(connection):
+    # Версия строки товара для кэша фрагментов: растёт при изменении полей,
+    # которые видны в карточке (резервы карточку не меняют)
+    columns = [row[1] for row in connection.execute(text("PRAGMA table_info(products)"))]
+    if 'version' not in columns:
+        connection.execute(text("ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+    connection.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS products_row_version AFTER UPDATE OF sku, name, description, price, "
+        "stock_quantity, category_id, image_url ON products BEGIN "
+        "UPDATE products SET version = version + 1 WHERE id = NEW.id; END"
+    ))
+
+
+def _utc_timestamps(connection):
+    # Время регистрации и срок действия промокодов записывались по Москве
+    # (UTC+3), остальные отметки времени уже хранились в UTC. Дробная часть
+    # секунд переносится как есть.
+    for table, column in (('users', 'created_at'), ('promo_codes', 'end_date')):
+        connection.execute(text(
+            f"UPDATE {table} SET {column} = datetime({column}, '-3 hours') || substr({column}, 20) "
+            f"WHERE {column} IS NOT NULL"
+        ))
+
+
+def _category_product_counts(connection):
+    # Число товаров в категории для главной страницы. Поддерживается
+    # триггерами только при добавлении, удалении и переносе товара, поэтому
+    # изменение остатков его не трогает и не требует пересчёта
+    columns = [row[1] for row in connection.execute(text("PRAGMA table_info(categories)"))]
+    if 'product_count' not in columns:
+        connection.execute(text("ALTER TABLE categories ADD COLUMN product_count INTEGER NOT NULL DEFAULT 0"))
+    connection.execute(text(
+        "UPDATE categories SET product_count = "
+        "(SELECT count(*) FROM products WHERE products.category_id = categories.id)"
+    ))
+    for name, event, body in (
+        ('products_category_count_insert', 'AFTER INSERT ON products',
+         "UPDATE categories SET product_count = product_count + 1 WHERE id = NEW.category_id;"),
+        ('products_category_count_delete', 'AFTER DELETE ON products',
+         "UPDATE categories SET product_count = product_count - 1 WHERE id = OLD.category_id;"),
+        ('products_category_count_update',
+         'AFTER UPDATE OF category_id ON products WHEN OLD.category_id IS NOT NEW.category_id',
+         "UPDATE categories SET product_count = product_count - 1 WHERE id = OLD.category_id; "
+         "UPDATE categories SET product_count = product_count + 1 WHERE id = NEW.category_id;"),
+    ):
+        connection.execute(text(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END"))
+
+
+def _product_version_sequence(connection):
+    # Версия строки товара берётся из общего счётчика каталога, а не
+    # считается с нуля: SQLite отдаёт id удалённого товара следующему, и пара
+    # (id, версия) нового товара совпадала с ключом карточки удалённого.
+    # Счётчик только растёт, поэтому пара больше не повторяется.
+    connection.execute(text("DROP TRIGGER IF EXISTS products_row_version"))
+    connection.execute(text(
+        "CREATE TRIGGER products_row_version AFTER UPDATE OF sku, name, description, price, "
+        "stock_quantity, category_id, image_url ON products BEGIN "
+        "UPDATE products SET version = (SELECT version FROM catalog_version WHERE id = 1) WHERE id = NEW.id; END"
+    ))
+    connection.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS products_row_version_insert AFTER INSERT ON products BEGIN "
+        "UPDATE products SET version = (SELECT version FROM catalog_version WHERE id = 1) WHERE id = NEW.id; END"
+    ))
+
+
+MIGRATIONS = [
+    (1, 'hot path indexes', _hot_path_indexes),
+    (2, 'unique cart per user', _unique_cart_per_user),
+    (3, 'cart version counter', _cart_version),
+    (4, 'order history index', _order_history_index),
+    (5, 'product name index', _product_name_index),
+    (6, 'product sku', _product_sku),
+    (7, 'catalog version counter', _catalog_version),
+    (8, 'stock reservations', _stock_reservations),
+    (9, 'sales analytics backfill', _sales_analytics),
+    (10, 'product row version', _product_row_version),
+    (11, 'utc timestamps', _utc_timestamps),
+    (12, 'category product counts', _category_product_counts),
+    (13, 'product version sequence', _product_version_sequence),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Запросы горячего пути; каждый обязан идти по индексу, а не сканировать таблицу
+HOT_QUERIES = {
+    'cart by user': "SELECT * FROM carts WHERE user_id = 1",
+    'cart items by cart': "SELECT * FROM cart_items WHERE cart_id = 1",
+    'cart item by cart and product': "SELECT * FROM cart_items WHERE cart_id = 1 AND product_id = 1",
+    'cart items by product': "SELECT * FROM cart_items WHERE product_id = 1",
+    'orders by user and promo': "SELECT * FROM orders WHERE user_id = 1 AND promo_code = 'CODE'",
+    'order history page': (
+        "SELECT * FROM orders WHERE user_id = 1 AND (created_at, id) < ('2030-01-01', 1) "
+        "ORDER BY created_at DESC, id DESC LIMIT 21"
+    ),
+    'order items by order': "SELECT * FROM order_items WHERE order_id = 1",
+    'products by category': "SELECT * FROM products WHERE category_id = 1",
+    'expired reservations': (
+        "SELECT id FROM stock_reservations WHERE expires_at <= '2030-01-01' ORDER BY expires_at LIMIT 500"
+    ),
+    'ready jobs': (
+        "SELECT id FROM jobs WHERE status = 'queued' AND run_after <= '2030-01-01' ORDER BY run_after, id LIMIT 1"
+    ),
+    'sales by day range': "SELECT * FROM sales_daily WHERE day BETWEEN '2030-01-01' AND '2030-01-31'",
+    'products by name prefix': "SELECT * FROM products WHERE name >= 'Ноут' AND name < 'Ноут\U0010ffff'",
+}
+
+
+def get_schema_version(connection):
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+def upgrade(db_engine):
+    if db_engine.dialect.name != 'sqlite':
+        return []
+    applied = []
+    with db_engine.begin() as connection:
+        version = get_schema_version(connection)
+        for number, name, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+            migrate(connection)
+            connection.execute(text(f'PRAGMA user_version = {int(number)}'))
+            applied.append(name)
+    return applied
+
+
+def check_query_plans(db_engine):
+    # Возвращает {название запроса: план} для запросов, которые не используют индекс
+    problems = {}
+    with db_engine.connect() as connection:
+        for name, query in HOT_QUERIES.items():
+            plan = [row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {query}'))]
+            if not any('USING' in step and 'INDEX' in step for step in plan):
+                problems[name] = plan
+    return problems
@@ -0,0 +1,180 @@
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Профилирование SQL по запросам. Включается переменной DB_PROFILE=1; без неё
+# обработчики событий движка не регистрируются и накладных расходов нет.
+PROFILE_ENABLED = os.environ.get('DB_PROFILE', '').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', 100))
+SLOWEST_PER_REQUEST = 5
+MAX_STATEMENTS = 2000
+
+logger = logging.getLogger('shop.sql')
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+def normalize_sql(statement):
+    # Одинаковые по форме запросы должны давать одну строку: литералы и
+    # списки параметров IN (?, ?, ...) заменяются на заполнители
+    statement = _WHITESPACE_RE.sub(' ', statement).strip()
+    statement = _STRING_RE.sub('?', statement)
+    statement = _NUMBER_RE.sub('?', statement)
+    return _IN_LIST_RE.sub('(?...)', statement)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.db_time = 0.0
+        self.statements = []
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.db_time += duration
+        self.statements.append((duration, statement))
+
+    def slowest(self, limit=SLOWEST_PER_REQUEST):
+        return heapq.nlargest(limit, self.statements, key=lambda item: item[0])
+
+
+class ProfileStats:
+    # Сводка по процессу: для каждого маршрута — число запросов и время,
+    # для каждой пары (маршрут, нормализованный SQL) — число вызовов и время
+    def __init__(self, max_statements=MAX_STATEMENTS):
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.routes = {}
+            self.statements = {}
+
+    def add(self, route, profile, elapsed):
+        normalized = {}
+        for duration, statement in profile.statements:
+            normalized.setdefault(normalize_sql(statement), []).append(duration)
+
+        with self._lock:
+            stats = self.routes.setdefault(route, {'requests': 0, 'queries': 0, 'db_time': 0.0, 'time': 0.0})
+            stats['requests'] += 1
+            stats['queries'] += profile.count
+            stats['db_time'] += profile.db_time
+            stats['time'] += elapsed
+
+            for sql, durations in normalized.items():
+                key = (route, sql)
+                stats = self.statements.get(key)
+                if stats is None:
+                    if len(self.statements) >= self.max_statements:
+                        continue
+                    stats = self.statements[key] = {'calls': 0, 'time': 0.0, 'max': 0.0}
+                stats['calls'] += len(durations)
+                stats['time'] += sum(durations)
+                stats['max'] = max(stats['max'], max(durations))
+
+    def snapshot(self, limit=50):
+        with self._lock:
+            routes = [
+                {
+                    'route': route,
+                    'requests': stats['requests'],
+                    'queries_per_request': round(stats['queries'] / stats['requests'], 2),
+                    'db_ms_per_request': round(stats['db_time'] / stats['requests'] * 1000, 2),
+                    'ms_per_request': round(stats['time'] / stats['requests'] * 1000, 2)
+                }
+                for route, stats in self.routes.items()
+            ]
+            statements = [
+                {
+                    'route': route,
+                    'sql': sql,
+                    'calls': stats['calls'],
+                    'total_ms': round(stats['time'] * 1000, 2),
+                    'avg_ms': round(stats['time'] / stats['calls'] * 1000, 3),
+                    'max_ms': round(stats['max'] * 1000, 2)
+                }
+                for (route, sql), stats in self.statements.items()
+            ]
+        routes.sort(key=lambda item: item['db_ms_per_request'] * item['requests'], reverse=True)
+        statements.sort(key=lambda item: item['total_ms'], reverse=True)
+        return {'routes': routes, 'statements': statements[:limit]}
+
+
+stats = ProfileStats()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.profile_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'profile_started', None)
+    if started is not None and has_request_context() and 'sql_profile' in g:
+        g.sql_profile.record(statement, time.perf_counter() - started)
+
+
+def _start_request():
+    g.sql_profile = RequestProfile()
+
+
+def _finish_request(response):
+    profile = g.pop('sql_profile', None)
+    if profile is None:
+        return response
+
+    elapsed = time.perf_counter() - profile.started
+    route = f'{request.method} {request.url_rule.rule if request.url_rule else request.path}'
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={profile.db_time * 1000:.2f};desc="{profile.count} queries", app;dur={elapsed * 1000:.2f}'
+    )
+
+    slowest = profile.slowest()
+    is_slow = bool(slowest) and slowest[0][0] * 1000 >= SLOW_QUERY_MS
+    logger.log(logging.WARNING if is_slow else logging.INFO, json.dumps({
+        'route': route,
+        'status': response.status_code,
+        'queries': profile.count,
+        'db_ms': round(profile.db_time * 1000, 2),
+        'total_ms': round(elapsed * 1000, 2),
+        'slowest': [
+            {'ms': round(duration * 1000, 2), 'sql': normalize_sql(statement)}
+            for duration, statement in slowest
+        ]
+    }, ensure_ascii=False))
+
+    stats.add(route, profile, elapsed)
+    return response
+
+
+def init_profiler(app, enabled=None):
+    enabled = PROFILE_ENABLED if enabled is None else enabled
+    app.config['DB_PROFILE'] = enabled
+    if not enabled:
+        return False
+
+    # Слушатели на классе Engine работают и для движков, пересозданных
+    # после init_profiler (global_init, новые воркеры)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    if not logger.handlers and not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    logger.setLevel(logging.INFO)
+    return True
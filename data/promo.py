@@ -0,0 +1,121 @@
+from collections import namedtuple
+from decimal import Decimal
+from sqlalchemy import update, case, or_
+from .__all_models import Order, PromoCode
+from .cache import LRUCache
+from .timeutils import utcnow
+
+PromoDefinition = namedtuple(
+    'PromoDefinition',
+    'id code discount max_activations activations_count end_date is_active is_reusable'
+)
+
+MIN_PROMO_TOTAL = Decimal('1000')
+PROMO_CACHE_TTL = 60
+
+# Описания промокодов по коду. Кэшируется и отсутствие кода (False), чтобы
+# перебор несуществующих кодов не ходил в базу. Счётчик активаций и скидка
+# в кэше используются только для подсказок: окончательно лимит проверяет
+# activate_promo одним UPDATE в базе, и скидка заказа берётся из его RETURNING.
+_promo_cache = LRUCache(maxsize=1024, ttl=PROMO_CACHE_TTL)
+
+
+class PromoError(Exception):
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.message = message
+        self.reason = reason
+
+
+def invalidate_promos(*codes):
+    if not codes:
+        _promo_cache.clear()
+    for code in codes:
+        if code:
+            _promo_cache.invalidate(code.strip().upper())
+
+
+def get_promo(db, code):
+    code = (code or '').strip().upper()
+    if not code:
+        return None
+
+    promo = _promo_cache.get(code)
+    if promo is None:
+        row = db.query(
+            PromoCode.id, PromoCode.code, PromoCode.discount, PromoCode.max_activations,
+            PromoCode.activations_count, PromoCode.end_date, PromoCode.is_active, PromoCode.is_reusable
+        ).filter(PromoCode.code == code).first()
+        promo = PromoDefinition(*row) if row else False
+        _promo_cache.set(code, promo)
+    return promo or None
+
+
+def evaluate_promo(db, code, user_id, cart_total):
+    # Все проверки промокода в одном месте; возвращает описание промокода
+    # или выбрасывает PromoError с причиной отказа
+    promo = get_promo(db, code)
+    if not promo or not promo.is_active:
+        raise PromoError('Недействительный промокод', 'invalid')
+
+    # end_date хранится в UTC, как и utcnow()
+    if promo.end_date and promo.end_date <= utcnow():
+        raise PromoError('Промокод истек', 'expired')
+
+    if promo.activations_count >= promo.max_activations:
+        raise PromoError('Лимит активаций исчерпан', 'exhausted')
+
+    if not promo.is_reusable:
+        used = db.query(Order.id).filter(
+            Order.user_id == user_id,
+            Order.promo_code == promo.code
+        ).first()
+        if used:
+            raise PromoError('Вы уже использовали этот промокод', 'already_used')
+
+    if cart_total < MIN_PROMO_TOTAL:
+        raise PromoError(f'Минимальная сумма заказа для промокода {MIN_PROMO_TOTAL} руб.', 'min_total')
+
+    return promo
+
+
+def apply_discount(total, promo):
+    discount = Decimal(str(promo.discount)) / Decimal(100)
+    return (total * (Decimal(1) - discount)).quantize(Decimal('0.01'))
+
+
+def activate_promo(db, promo):
+    # Атомарно занимает одну активацию: при гонке за последнюю активацию
+    # условие WHERE пропустит только один UPDATE. Срок действия проверяется
+    # здесь же, если промокод истёк после evaluate_promo. Возвращает описание
+    # промокода из базы на момент активации: скидку считают по нему, а не по
+    # кэшу процесса, который в другом воркере мог устареть
+    now = utcnow()
+    row = db.execute(
+        update(PromoCode).where(
+            PromoCode.id == promo.id,
+            PromoCode.is_active.is_(True),
+            PromoCode.activations_count < PromoCode.max_activations,
+            or_(PromoCode.end_date.is_(None), PromoCode.end_date > now)
+        ).values(
+            activations_count=PromoCode.activations_count + 1,
+            is_active=case(
+                (PromoCode.activations_count + 1 >= PromoCode.max_activations, False),
+                else_=PromoCode.is_active
+            )
+        ).returning(
+            PromoCode.id, PromoCode.code, PromoCode.discount, PromoCode.max_activations,
+            PromoCode.activations_count, PromoCode.end_date, PromoCode.is_active, PromoCode.is_reusable
+        ).execution_options(synchronize_session=False)
+    ).first()
+
+    if row is None:
+        invalidate_promos(promo.code)
+        current = get_promo(db, promo.code)
+        if current and current.end_date and current.end_date <= now:
+            raise PromoError('Промокод истек', 'expired')
+        raise PromoError('Лимит активаций промокода исчерпан', 'exhausted')
+    # Кэш не обновляется значениями из RETURNING: транзакцию вызывающий код
+    # ещё может откатить, и тогда кэш хранил бы несостоявшуюся активацию
+    _promo_cache.invalidate(promo.code)
+    return PromoDefinition(*row)
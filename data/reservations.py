@@ -0,0 +1,148 @@
+import logging
+import os
+import threading
+from datetime import timedelta
+from sqlalchemy import select, update, delete, func, or_, bindparam
+from sqlalchemy.dialects.sqlite import insert
+from .__all_models import Product, StockReservation
+from .timeutils import utcnow
+
+# Резерв держит товар за корзиной RESERVATION_TTL секунд после последнего
+# изменения позиции. Product.reserved_quantity — сумма активных резервов по
+# товару, её меняют только функции этого модуля; доступно для продажи
+# stock_quantity - reserved_quantity.
+RESERVATION_TTL = int(os.environ.get('RESERVATION_TTL', 900))
+SWEEP_INTERVAL = int(os.environ.get('RESERVATION_SWEEP_INTERVAL', 60))
+SWEEP_BATCH_SIZE = 500
+
+logger = logging.getLogger('shop.reservations')
+
+
+def own_reserved(cart_id, product_id=Product.id):
+    return func.coalesce(select(StockReservation.quantity).where(
+        StockReservation.cart_id == cart_id,
+        StockReservation.product_id == product_id
+    ).scalar_subquery(), 0)
+
+
+def available_for_cart(cart_id, product_id=Product.id):
+    # Сколько единиц товара может взять корзина: свободный остаток плюс её
+    # собственный резерв
+    return (func.coalesce(Product.stock_quantity, 0) - Product.reserved_quantity
+            + own_reserved(cart_id, product_id))
+
+
+def hold_stock(db, cart_id, product_id, quantity, now=None):
+    # Устанавливает резерв корзины на товар равным quantity (0 снимает резерв).
+    # Увеличение проходит, только если хватает свободного остатка; проверка и
+    # изменение reserved_quantity делаются одним UPDATE. Возвращает False,
+    # если товара не хватило; коммит остаётся за вызывающим кодом.
+    own = own_reserved(cart_id, product_id)
+    held = db.execute(
+        update(Product).where(
+            Product.id == product_id,
+            or_(own >= quantity, available_for_cart(cart_id, product_id) >= quantity)
+        ).values(
+            reserved_quantity=Product.reserved_quantity + quantity - own
+        ).execution_options(synchronize_session=False)
+    ).rowcount
+    if not held:
+        return False
+
+    if quantity > 0:
+        expires_at = (now or utcnow()) + timedelta(seconds=RESERVATION_TTL)
+        statement = insert(StockReservation).values(
+            cart_id=cart_id, product_id=product_id, quantity=quantity, expires_at=expires_at
+        )
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[StockReservation.cart_id, StockReservation.product_id],
+            set_={'quantity': quantity, 'expires_at': expires_at}
+        ))
+    else:
+        db.execute(delete(StockReservation).where(
+            StockReservation.cart_id == cart_id,
+            StockReservation.product_id == product_id
+        ))
+    return True
+
+
+def release_cart(db, cart_id):
+    # Снимает все резервы корзины (после оформления заказа)
+    db.execute(
+        update(Product).where(
+            Product.id.in_(select(StockReservation.product_id).where(StockReservation.cart_id == cart_id))
+        ).values(
+            reserved_quantity=Product.reserved_quantity - own_reserved(cart_id)
+        ).execution_options(synchronize_session=False)
+    )
+    db.execute(delete(StockReservation).where(StockReservation.cart_id == cart_id))
+
+
+def release_products(db, product_ids):
+    # Резервы удаляемых товаров; reserved_quantity уходит вместе с товаром
+    db.execute(delete(StockReservation).where(StockReservation.product_id.in_(product_ids)))
+
+
+def expire_reservations(db, now=None, batch_size=SWEEP_BATCH_SIZE):
+    # Удаляет пачку просроченных резервов и возвращает их количество на склад
+    # одной транзакцией вызывающего кода. DELETE ... RETURNING сразу забирает
+    # строки, поэтому параллельный сборщик не вернёт их второй раз.
+    now = now or utcnow()
+    expired = db.execute(
+        delete(StockReservation).where(StockReservation.id.in_(
+            select(StockReservation.id).where(StockReservation.expires_at <= now)
+            .order_by(StockReservation.expires_at).limit(batch_size)
+        )).returning(StockReservation.product_id, StockReservation.quantity)
+    ).all()
+    if not expired:
+        return 0
+
+    released = {}
+    for product_id, quantity in expired:
+        released[product_id] = released.get(product_id, 0) + quantity
+    table = Product.__table__
+    db.execute(
+        update(table).where(table.c.id == bindparam('released_product_id')).values(
+            reserved_quantity=func.max(table.c.reserved_quantity - bindparam('released_quantity'), 0)
+        ),
+        [
+            {'released_product_id': product_id, 'released_quantity': quantity}
+            for product_id, quantity in released.items()
+        ]
+    )
+    return len(expired)
+
+
+def sweep_reservations(session_factory, batch_size=SWEEP_BATCH_SIZE):
+    # Каждая пачка коммитится отдельно, чтобы не держать блокировку записи
+    total = 0
+    while True:
+        db = session_factory()
+        try:
+            count = expire_reservations(db, batch_size=batch_size)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        total += count
+        if count < batch_size:
+            return total
+
+
+def start_sweeper(session_factory, interval=SWEEP_INTERVAL):
+    if interval <= 0:
+        return None
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                sweep_reservations(session_factory)
+            except Exception:
+                logger.exception('Не удалось снять просроченные резервы')
+
+    thread = threading.Thread(target=run, name='reservation-sweeper', daemon=True)
+    thread.start()
+    return stop
@@ -0,0 +1,143 @@
+import re
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload
+from .__all_models import Product
+
+# Внешний FTS5-индекс поверх products: сам текст хранится только в products,
+# индекс поддерживается триггерами при любых INSERT/UPDATE/DELETE.
+SEARCH_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, description)
+        VALUES (new.id, new.name, coalesce(new.description, ''));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, coalesce(old.description, ''));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, coalesce(old.description, ''));
+        INSERT INTO products_fts(rowid, name, description)
+        VALUES (new.id, new.name, coalesce(new.description, ''));
+    END
+    """,
+]
+
+# Вес совпадения в названии выше, чем в описании
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+# Сколько первых совпадений группы упорядочивается по bm25; остальные идут
+# следом по id. На коротком префиксе совпадает почти весь каталог, и
+# ранжировать его целиком слишком дорого
+SEARCH_RANK_WINDOW = 200
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def create_search_index(db_engine):
+    if db_engine.dialect.name != 'sqlite':
+        return
+    with db_engine.begin() as connection:
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+        ).first()
+        for statement in SEARCH_SCHEMA:
+            connection.execute(text(statement))
+        if not exists:
+            connection.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+
+
+def build_match_query(query):
+    # Каждое слово экранируется как строка FTS5; все слова ищутся по префиксу,
+    # чтобы поиск работал при наборе ("ноут" находит "ноутбук")
+    tokens = _TOKEN_RE.findall(query or '')
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def _match_ids(db, match, category_id, limit, offset):
+    # FTS-таблица всегда ведущая (CROSS JOIN): иначе при фильтре по категории
+    # SQLite перебирает все товары категории и проверяет MATCH для каждого
+    params = {'match': match, 'category_id': category_id, 'window': SEARCH_RANK_WINDOW}
+    category_filter = 'AND products.category_id = :category_id' if category_id else ''
+    candidates = f"""
+        FROM products_fts
+        CROSS JOIN products ON products.id = products_fts.rowid
+        WHERE products_fts MATCH :match {category_filter}
+    """
+
+    ids = []
+    ranked_limit = min(limit, SEARCH_RANK_WINDOW - offset) if offset < SEARCH_RANK_WINDOW else 0
+    if ranked_limit:
+        ids = [row[0] for row in db.execute(text(f"""
+            SELECT rowid FROM (
+                SELECT products_fts.rowid AS rowid,
+                       bm25(products_fts, {NAME_WEIGHT}, {DESCRIPTION_WEIGHT}) AS score
+                {candidates}
+                LIMIT :window
+            )
+            ORDER BY score, rowid
+            LIMIT :limit OFFSET :offset
+        """), dict(params, limit=ranked_limit, offset=offset))]
+    if len(ids) == ranked_limit < limit:
+        # Окно ранжирования заполнено: продолжение по id за его пределами
+        ids += [row[0] for row in db.execute(text(f"""
+            SELECT products_fts.rowid
+            {candidates}
+            LIMIT :limit OFFSET :offset
+        """), dict(params, limit=limit - len(ids), offset=max(offset, SEARCH_RANK_WINDOW)))]
+    return ids
+
+
+def _match_count(db, match, category_id):
+    # Без фильтра по категории считается по одному индексу, без обращения к
+    # строкам products
+    if not category_id:
+        return db.execute(text("SELECT count(*) FROM products_fts WHERE products_fts MATCH :match"),
+                          {'match': match}).scalar()
+    return db.execute(text("""
+        SELECT count(*)
+        FROM products_fts
+        CROSS JOIN products ON products.id = products_fts.rowid
+        WHERE products_fts MATCH :match AND products.category_id = :category_id
+    """), {'match': match, 'category_id': category_id}).scalar()
+
+
+def search_products(db, query, category_id=None, limit=24, offset=0, with_total=True, names_only=False):
+    # Сначала товары, у которых слова нашлись в названии, затем остальные;
+    # внутри группы по bm25 в пределах SEARCH_RANK_WINDOW, поэтому каждый
+    # запрос ограничен, даже если совпадает весь каталог.
+    match = build_match_query(query)
+    if not match:
+        return [], 0
+
+    name_match = f'name : ({match})'
+    ids = _match_ids(db, name_match, category_id, limit, offset)
+    if len(ids) < limit and not names_only:
+        name_total = offset + len(ids) if ids or not offset else _match_count(db, name_match, category_id)
+        ids += _match_ids(
+            db, f'({match}) NOT {name_match}', category_id, limit - len(ids), max(offset - name_total, 0)
+        )
+    total = None
+    if with_total:
+        total = _match_count(db, name_match if names_only else match, category_id)
+
+    if not ids:
+        return [], total
+    products = {
+        product.id: product
+        for product in db.query(Product).options(joinedload(Product.category)).filter(Product.id.in_(ids))
+    }
+    return [products[product_id] for product_id in ids if product_id in products], total
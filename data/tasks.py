@@ -0,0 +1,47 @@
+from .__all_models import Product, OrderItem
+from .analytics import record_order_by_id, RECORD_ORDER_TASK
+from .images import remove_image
+from .jobs import task, enqueue
+
+IMAGE_CLEANUP_TASK = 'images.cleanup'
+PURGE_PRODUCTS_TASK = 'catalog.purge_products'
+
+
+@task(RECORD_ORDER_TASK)
+def record_order_analytics(db, order_id):
+    record_order_by_id(db, order_id)
+
+
+@task(IMAGE_CLEANUP_TASK)
+def cleanup_image(db, folder, image_url):
+    # Пока задача ждала в очереди, то же изображение (имя по хэшу содержимого)
+    # могли снова загрузить для другого товара
+    if not db.query(Product.id).filter(Product.image_url == image_url).first():
+        remove_image(folder, image_url)
+
+
+@task(PURGE_PRODUCTS_TASK)
+def purge_products(db, product_ids, image_urls, folder):
+    # Хвосты удалённых товаров: позиции заказов и файлы изображений. Id,
+    # которые SQLite успел выдать новым товарам, пропускаются.
+    reused = {row.id for row in db.query(Product.id).filter(Product.id.in_(product_ids))}
+    product_ids = [product_id for product_id in product_ids if product_id not in reused]
+    if product_ids:
+        db.query(OrderItem).filter(OrderItem.product_id.in_(product_ids)).delete(synchronize_session=False)
+    for image_url in sorted(set(filter(None, image_urls))):
+        enqueue(db, IMAGE_CLEANUP_TASK, folder=folder, image_url=image_url)
+
+
+def release_image(db, folder, image_url):
+    if image_url:
+        enqueue(db, IMAGE_CLEANUP_TASK, folder=folder, image_url=image_url)
+
+
+def purge_products_later(db, products, folder):
+    # products — строки (id, image_url) уже удаляемых товаров
+    enqueue(
+        db, PURGE_PRODUCTS_TASK,
+        product_ids=[product.id for product in products],
+        image_urls=[product.image_url for product in products],
+        folder=folder
+    )
@@ -0,0 +1,44 @@
+import os
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+# Все отметки времени хранятся в UTC без tzinfo: SQLite смещение не хранит, а
+# сравнения в SQL идут по самой колонке без преобразований и могут
+# использовать индекс. В местное время переводится только вывод.
+DISPLAY_TIMEZONE = ZoneInfo(os.environ.get('DISPLAY_TIMEZONE', 'Europe/Moscow'))
+DATETIME_FORMAT = '%d.%m.%Y %H:%M'
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def to_utc(value, tz=DISPLAY_TIMEZONE):
+    # Время без пояса (из формы) считается местным
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz)
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def to_local(value, tz=DISPLAY_TIMEZONE):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(tz)
+
+
+def format_local(value, fmt=DATETIME_FORMAT):
+    return to_local(value).strftime(fmt) if value is not None else ''
+
+
+def format_local_column(rows, attribute, fmt=DATETIME_FORMAT):
+    # Колонка времени всех строк одним вызовом фильтра вместо преобразования
+    # в цикле шаблона; список идёт в том же порядке, что и rows
+    utc, tz = timezone.utc, DISPLAY_TIMEZONE
+    return [
+        value.replace(tzinfo=utc).astimezone(tz).strftime(fmt) if value is not None else ''
+        for value in (getattr(row, attribute) for row in rows)
+    ]
@@ -0,0 +1,39 @@
+import multiprocessing
+import os
+
+# gunicorn -c gunicorn.conf.py wsgi:application
+#
+# Приложение загружается один раз в мастер-процессе (preload_app) и
+# наследуется воркерами через fork. Мастер не подключается к базе и не
+# запускает потоков: это происходит в воркерах при первом запросе.
+# Плавный перезапуск воркеров: kill -HUP <pid мастера>; при выкладке нового
+# кода — kill -USR2, затем kill -QUIT старому мастеру (см. README).
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+# SQLite допускает одного писателя, поэтому больше воркеров, чем ядер,
+# только увеличивает ожидание блокировки
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() + 1))
+worker_class = 'gthread'
+# Потоки покрывают ожидание диска и busy_timeout SQLite; рендеринг шаблонов
+# упирается в GIL, и больше потоков не дают
+threads = int(os.environ.get('WEB_THREADS', 4))
+# Соединений в пуле хватает на все потоки запросов, обработчики очереди и
+# сборщик резервов
+os.environ.setdefault('DB_POOL_SIZE', str(threads + int(os.environ.get('JOB_WORKERS', 1)) + 1))
+
+preload_app = True
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# Периодический перезапуск воркеров ограничивает рост памяти процесса
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+pidfile = os.environ.get('WEB_PIDFILE')
+accesslog = os.environ.get('WEB_ACCESS_LOG')
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Если мастер всё же открыл соединения, воркер их не использует
+    from data import db_session
+    db_session.reset_after_fork()
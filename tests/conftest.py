@@ -0,0 +1,61 @@
+import os
+import sys
+from decimal import Decimal
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Тесты не запускают фоновые потоки приложения
+os.environ.setdefault('BACKGROUND_TASKS', '0')
+os.environ.setdefault('JOB_WORKERS', '0')
+
+from data import db_session
+from data.__all_models import User, Category, Product, PromoCode
+from data.cache import cart_count_cache, catalog_cache
+from data.cart import _totals_cache
+from data.fragments import fragment_cache
+from data.promo import _promo_cache
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    # Отдельная мигрированная база в файле на каждый тест; кэши процесса
+    # ключуются id строк, поэтому очищаются вместе с базой
+    for cache in (cart_count_cache, catalog_cache, _totals_cache, fragment_cache, _promo_cache):
+        cache.clear()
+    db_session.global_init(str(tmp_path / 'shop.db'))
+    yield db_session.SessionLocal
+    db_session.engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+def make_users(db, count):
+    users = [
+        User(name=f'User{i}', surname='Test', email=f'user{i}@test.local', password='x', phone=f'+7900000{i:04d}')
+        for i in range(count)
+    ]
+    db.add_all(users)
+    db.commit()
+    return users
+
+
+def make_product(db, stock, price='100.00', name='Товар', category=None):
+    if category is None:
+        category = db.query(Category).first() or Category(name='Категория')
+    product = Product(name=name, price=Decimal(price), stock_quantity=stock, category=category)
+    db.add(product)
+    db.commit()
+    return product
+
+
+def make_promo(db, code, discount, max_activations, is_reusable=True):
+    promo = PromoCode(code=code, discount=discount, max_activations=max_activations, activations_count=0,
+                      is_active=True, is_reusable=is_reusable)
+    db.add(promo)
+    db.commit()
+    return promo
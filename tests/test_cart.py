@@ -0,0 +1,76 @@
+from datetime import timedelta
+from data.__all_models import CartItem, StockReservation, Product
+from data.cart import add_item, set_item_quantity
+from data.reservations import expire_reservations
+from data.timeutils import utcnow
+from conftest import make_users, make_product
+
+
+def test_decrease_after_hold_expired_and_stock_taken(db):
+    first, second = make_users(db, 2)
+    product = make_product(db, stock=3)
+    for _ in range(3):
+        add_item(db, first.id, product.id)
+    db.commit()
+
+    db.query(StockReservation).update({'expires_at': utcnow() - timedelta(seconds=1)})
+    expire_reservations(db)
+    db.commit()
+    for _ in range(3):
+        add_item(db, second.id, product.id)
+    db.commit()
+
+    item = db.query(CartItem).join(CartItem.cart).filter_by(user_id=first.id).one()
+    assert set_item_quantity(db, first.id, item.id, 2) == 2
+    db.commit()
+
+    db.expire_all()
+    assert db.get(CartItem, item.id).quantity == 2
+    assert db.get(Product, product.id).reserved_quantity == 3
+    own = db.query(StockReservation).filter_by(cart_id=item.cart_id).first()
+    assert own is None
+
+
+def test_decrease_keeps_what_is_still_available(db):
+    first, second = make_users(db, 2)
+    product = make_product(db, stock=5)
+    for _ in range(4):
+        add_item(db, first.id, product.id)
+    db.commit()
+
+    db.query(StockReservation).update({'expires_at': utcnow() - timedelta(seconds=1)})
+    expire_reservations(db)
+    for _ in range(3):
+        add_item(db, second.id, product.id)
+    db.commit()
+
+    item = db.query(CartItem).join(CartItem.cart).filter_by(user_id=first.id).one()
+    set_item_quantity(db, first.id, item.id, 3)
+    db.commit()
+
+    own = db.query(StockReservation).filter_by(cart_id=item.cart_id).one()
+    assert own.quantity == 2
+    assert db.get(Product, product.id).reserved_quantity == 5
+
+
+def test_update_cart_route_changes_quantity_by_action(db):
+    from app import app
+
+    owner, stranger = make_users(db, 2)
+    product = make_product(db, stock=5)
+    add_item(db, owner.id, product.id)
+    db.commit()
+    item = db.query(CartItem).join(CartItem.cart).filter_by(user_id=owner.id).one()
+
+    client = app.test_client()
+    client.post('/login', data={'email': stranger.email, 'password': 'x'})
+    client.post(f'/update_cart/{item.id}', data={'action': 'increment'})
+    db.expire_all()
+    assert db.get(CartItem, item.id).quantity == 1
+
+    client.post('/login', data={'email': owner.email, 'password': 'x'})
+    client.post(f'/update_cart/{item.id}', data={'action': 'increment'})
+    client.post(f'/update_cart/{item.id}', data={'action': 'increment'})
+    client.post(f'/update_cart/{item.id}', data={'action': 'decrement'})
+    db.expire_all()
+    assert db.get(CartItem, item.id).quantity == 2
@@ -0,0 +1,29 @@
+from data.__all_models import Category, Product
+from conftest import make_product
+
+
+def _counts(db):
+    db.expire_all()
+    return dict(db.query(Category.name, Category.product_count))
+
+
+def test_category_counts_follow_products(db):
+    books = Category(name='Книги')
+    toys = Category(name='Игрушки')
+    db.add_all([books, toys])
+    db.commit()
+    first = make_product(db, stock=5, category=books)
+    make_product(db, stock=5, category=books)
+    assert _counts(db) == {'Книги': 2, 'Игрушки': 0}
+
+    first.stock_quantity = 1
+    db.commit()
+    assert _counts(db) == {'Книги': 2, 'Игрушки': 0}
+
+    first.category_id = toys.id
+    db.commit()
+    assert _counts(db) == {'Книги': 1, 'Игрушки': 1}
+
+    db.query(Product).filter_by(id=first.id).delete()
+    db.commit()
+    assert _counts(db) == {'Книги': 1, 'Игрушки': 0}
@@ -0,0 +1,73 @@
+import io
+import pytest
+from decimal import Decimal
+from data.__all_models import Product
+from data.catalog_io import import_products, read_rows, validate_row
+
+
+def _row(**fields):
+    return dict({'sku': 'A-1', 'name': 'Товар', 'category': 'Категория', 'price': '10'}, **fields)
+
+
+@pytest.mark.parametrize('price', ['NaN', 'sNaN', 'Infinity', '-inf', '1e400', 'abc', None])
+def test_invalid_price_is_row_error(price):
+    with pytest.raises(ValueError):
+        validate_row(_row(price=price))
+
+
+def test_price_is_quantized():
+    assert validate_row(_row(price='12,3'))['price'] == Decimal('12.30')
+
+
+def _import(db, text):
+    return import_products(db, read_rows(io.BytesIO(text.encode('utf-8')), 'csv'))
+
+
+def test_missing_columns_keep_description_and_image(db):
+    _import(db, 'sku,name,description,price,stock_quantity,category,image_url\n'
+                'A-1,Товар,Описание,10,5,Категория,https://example.com/a.png\n')
+    report = _import(db, 'sku,name,price,stock_quantity,category\nA-1,Товар,20,7,Категория\n')
+    assert report['updated'] == 1
+
+    product = db.query(Product).filter_by(sku='A-1').one()
+    assert (product.description, product.image_url) == ('Описание', 'https://example.com/a.png')
+    assert (product.price, product.stock_quantity) == (Decimal('20.00'), 7)
+
+
+def test_empty_image_clears_it(db):
+    _import(db, 'sku,name,price,category,image_url\nA-1,Товар,10,Категория,https://example.com/a.png\n')
+    _import(db, 'sku,name,price,category,image_url\nA-1,Товар,10,Категория,\n')
+    product = db.query(Product).filter_by(sku='A-1').one()
+    assert product.image_url is None
+    assert product.description == ''
+
+
+def test_bad_price_does_not_break_import(db):
+    report = _import(db, 'sku,name,price,category\nA-1,Товар,NaN,Категория\nA-2,Товар,1e400,Категория\n'
+                         'A-3,Товар,5,Категория\n')
+    assert report['created'] == 1
+    assert [error['line'] for error in report['errors']] == [2, 3]
+
+
+def test_missing_or_empty_stock_keeps_stored_stock(db):
+    _import(db, 'sku,name,price,stock_quantity,category\nA-1,Товар,10,50,Категория\nA-2,Товар,10,7,Категория\n')
+    _import(db, 'sku,name,price,category\nA-1,Товар,20,Категория\nA-3,Новый,5,Категория\n')
+    _import(db, 'sku,name,price,stock_quantity,category\nA-2,Товар,10,,Категория\n')
+
+    stock = dict(db.query(Product.sku, Product.stock_quantity))
+    assert stock == {'A-1': 50, 'A-2': 7, 'A-3': 0}
+    assert db.query(Product.price).filter_by(sku='A-1').scalar() == Decimal('20.00')
+
+
+def test_price_change_resets_cart_totals(db):
+    from data.cart import add_item, get_cart_totals
+    from conftest import make_users
+
+    _import(db, 'sku,name,price,stock_quantity,category\nA-1,Товар,10,5,Категория\n')
+    user, = make_users(db, 1)
+    add_item(db, user.id, db.query(Product.id).filter_by(sku='A-1').scalar())
+    db.commit()
+    assert get_cart_totals(db, user.id).subtotal == Decimal('10.00')
+
+    _import(db, 'sku,name,price,category\nA-1,Товар,15,Категория\n')
+    assert get_cart_totals(db, user.id).subtotal == Decimal('15.00')
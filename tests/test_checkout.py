@@ -0,0 +1,86 @@
+import threading
+from decimal import Decimal
+from data.__all_models import User, Product, Cart, CartItem, Order, PromoCode
+from data.cart import add_item
+from data.checkout import place_order, CheckoutError
+from data.promo import get_promo
+from conftest import make_users, make_product, make_promo
+
+ADDRESS = {'country': 'Россия', 'city': 'Москва', 'street': 'Тверская', 'house': '1',
+           'apartment': '', 'additional_info': ''}
+
+
+def test_discount_comes_from_database_not_cache(db):
+    user, = make_users(db, 1)
+    product = make_product(db, stock=5, price='1500.00')
+    promo = make_promo(db, 'SALE', discount=10, max_activations=5)
+    add_item(db, user.id, product.id)
+    db.commit()
+
+    # Кэш этого процесса помнит старую скидку, в базе её уже поменяли
+    assert get_promo(db, 'SALE').discount == 10
+    db.query(PromoCode).filter_by(id=promo.id).update({'discount': 50})
+    db.commit()
+
+    order, warnings = place_order(db, user, ADDRESS, 'SALE')
+    db.commit()
+    assert warnings == []
+    assert order.total_amount == Decimal('750.00')
+    assert get_promo(db, 'SALE').discount == 50
+
+
+def test_concurrent_orders_do_not_oversell(session_factory):
+    db = session_factory()
+    users = make_users(db, 10)
+    product = make_product(db, stock=3, price='1500.00')
+    make_promo(db, 'RUSH', discount=10, max_activations=2)
+    # Корзины заполняются напрямую, без резервов: остатки и лимит промокода
+    # должно удержать само оформление заказа
+    for user in users:
+        cart = Cart(user_id=user.id)
+        db.add(cart)
+        db.flush()
+        db.add(CartItem(cart_id=cart.id, product_id=product.id, quantity=1))
+    db.commit()
+    user_ids = [user.id for user in users]
+    product_id = product.id
+    db.close()
+
+    barrier = threading.Barrier(len(user_ids))
+    results, rejected, errors = [], [], []
+
+    def buy(user_id):
+        session = session_factory()
+        try:
+            user = session.get(User, user_id)
+            barrier.wait()
+            order, warnings = place_order(session, user, ADDRESS, 'RUSH')
+            session.commit()
+            results.append(order.promo_code)
+        except CheckoutError as e:
+            session.rollback()
+            rejected.append(e.reason)
+        except Exception as e:
+            # Ошибки блокировок и целостности — не ожидаемый отказ, а провал
+            session.rollback()
+            errors.append(repr(e))
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=buy, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(results) == 3
+    assert rejected == ['out_of_stock'] * 7
+    assert sorted(results, key=str) == [None, 'RUSH', 'RUSH']
+
+    db = session_factory()
+    assert db.query(Product.stock_quantity).filter_by(id=product_id).scalar() == 0
+    assert db.query(PromoCode.activations_count).filter_by(code='RUSH').scalar() == 2
+    assert db.query(Order).count() == 3
+    assert db.query(Order).filter_by(promo_code='RUSH').count() == 2
+    db.close()
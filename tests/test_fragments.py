@@ -0,0 +1,20 @@
+from data.__all_models import Product
+from conftest import make_product
+
+
+def test_reused_product_id_gets_its_own_card(db):
+    from app import app
+
+    client = app.test_client()
+    old = make_product(db, stock=5, name='Старый товар')
+    old_id = old.id
+    assert 'Старый товар' in client.get('/').get_data(as_text=True)
+
+    db.query(Product).filter_by(id=old_id).delete()
+    db.commit()
+    new = make_product(db, stock=5, name='Новый товар')
+    assert new.id == old_id
+
+    page = client.get('/').get_data(as_text=True)
+    assert 'Новый товар' in page
+    assert 'Старый товар' not in page
@@ -0,0 +1,16 @@
+import logging
+from data.images import remove_image, variant_name, KEY_LENGTH
+
+KEY = 'a' * KEY_LENGTH
+
+
+def test_failed_cleanup_is_logged(tmp_path, caplog):
+    (tmp_path / variant_name(KEY, 'card', 'webp')).mkdir()
+    (tmp_path / variant_name(KEY, 'thumb', 'png')).write_bytes(b'x')
+
+    with caplog.at_level(logging.ERROR, logger='shop.images'):
+        remove_image(str(tmp_path), KEY)
+
+    assert not (tmp_path / variant_name(KEY, 'thumb', 'png')).exists()
+    assert [record.levelname for record in caplog.records] == ['ERROR']
+    assert variant_name(KEY, 'card', 'webp') in caplog.records[0].getMessage()
@@ -0,0 +1,14 @@
+from data.promo import get_promo, activate_promo
+from conftest import make_promo
+
+
+def test_rolled_back_activation_does_not_stay_in_cache(db):
+    make_promo(db, 'LAST', discount=10, max_activations=1)
+    promo = get_promo(db, 'LAST')
+
+    activated = activate_promo(db, promo)
+    assert (activated.activations_count, activated.is_active) == (1, False)
+    db.rollback()
+
+    cached = get_promo(db, 'LAST')
+    assert (cached.activations_count, cached.is_active) == (0, True)
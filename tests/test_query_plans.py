@@ -0,0 +1,104 @@
+import re
+import pytest
+from sqlalchemy import event
+from data import db_session, jobs
+from data.__all_models import Category, Product
+from data.migrations import check_query_plans
+from data.reservations import expire_reservations
+from conftest import make_users, make_promo
+
+# Таблицы, которые растут вместе с магазином: их нельзя читать полным проходом
+LARGE_TABLES = ('products', 'carts', 'cart_items', 'orders', 'order_items', 'stock_reservations', 'jobs')
+_TABLE_STEP_RE = re.compile(rf"^(SCAN|SEARCH) ({'|'.join(LARGE_TABLES)})(_\d+)?\b")
+_INDEXED_RE = re.compile(r'USING (INDEX|COVERING INDEX|INTEGER PRIMARY KEY|PRIMARY KEY)')
+
+
+@pytest.fixture
+def statements(session_factory):
+    # Настоящие запросы приложения: всё, что ушло в базу за время теста
+    captured = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+            captured.append((statement, parameters))
+
+    engine = db_session.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield captured
+    event.remove(engine, 'before_cursor_execute', record)
+
+
+def _storefront_traffic(session_factory):
+    from app import app
+
+    db = session_factory()
+    user, = make_users(db, 1)
+    category = Category(name='Ноутбуки')
+    db.add_all([
+        Product(name=f'Ноутбук {i}', description='игровой', price=1500, stock_quantity=10, category=category)
+        for i in range(30)
+    ])
+    db.commit()
+    make_promo(db, 'SALE', discount=10, max_activations=5)
+    email, category_id, product_id = user.email, category.id, db.query(Product.id).first()[0]
+    db.close()
+
+    client = app.test_client()
+
+    def visit(method, path, **kwargs):
+        response = client.open(path, method=method, **kwargs)
+        assert response.status_code < 400, (path, response.status_code)
+        return response
+
+    visit('GET', '/')
+    visit('GET', f'/category/{category_id}?page=2')
+    visit('GET', '/search?q=ноут')
+    visit('GET', f'/search?q=ноут&category={category_id}')
+    visit('GET', '/api/search/suggest?q=но')
+    visit('POST', '/login', data={'email': email, 'password': 'x'})
+    visit('POST', f'/add_to_cart/{product_id}')
+    visit('POST', f'/api/cart/add/{product_id}')
+    visit('GET', '/cart')
+    visit('POST', '/api/apply_promo', json={'code': 'SALE'})
+    visit('GET', '/delivery')
+    visit('POST', '/delivery', data={'country': 'Россия', 'city': 'Москва', 'street': 'Тверская', 'house': '1',
+                                     'promo_code': 'SALE'})
+    visit('GET', '/orders')
+    visit('GET', '/orders/1')
+
+    token = visit('POST', '/api/v1/auth/token', json={'email': email, 'password': 'x'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    visit('GET', '/api/v1/categories')
+    visit('GET', f'/api/v1/products?category_id={category_id}&limit=5')
+    visit('GET', f'/api/v1/products/{product_id}')
+    visit('POST', '/api/v1/cart/items', json={'product_id': product_id, 'quantity': 1}, headers=headers)
+    visit('GET', '/api/v1/cart', headers=headers)
+    visit('GET', '/api/v1/orders', headers=headers)
+
+    jobs.run_pending(session_factory)
+    db = session_factory()
+    expire_reservations(db)
+    jobs.housekeeping(db)
+    db.commit()
+    db.close()
+
+
+def _plan(connection, statement, parameters):
+    return [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+
+
+def test_hot_queries_use_indexes(session_factory):
+    assert check_query_plans(db_session.engine) == {}
+
+
+def test_application_queries_use_indexes(session_factory, statements):
+    _storefront_traffic(session_factory)
+    assert len(statements) > 50
+
+    problems = {}
+    with db_session.engine.connect() as connection:
+        for statement, parameters in statements:
+            for step in _plan(connection, statement, parameters):
+                if _TABLE_STEP_RE.match(step) and not _INDEXED_RE.search(step):
+                    problems.setdefault(statement, []).append(step)
+    assert problems == {}
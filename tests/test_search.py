@@ -0,0 +1,55 @@
+from data import search
+from data.__all_models import Category, Product
+from data.search import search_products
+
+
+def _catalog(db):
+    laptops = Category(name='Ноутбуки')
+    bags = Category(name='Сумки')
+    db.add_all([
+        Product(name='Сумка для ноутбука и планшета', description='', price=10, category=bags),
+        Product(name='Мышь', description='подходит к ноутбуку', price=10, category=laptops),
+        Product(name='Ноутбук игровой 15 дюймов', description='', price=10, category=laptops),
+        Product(name='Кабель', description='', price=10, category=laptops),
+        Product(name='Ноутбук', description='', price=10, category=laptops),
+    ])
+    db.commit()
+    return laptops
+
+
+def _names(products):
+    return [product.name for product in products]
+
+
+def test_name_matches_ranked_by_relevance_then_descriptions(db):
+    _catalog(db)
+    products, total = search_products(db, 'ноутбук')
+    assert _names(products) == ['Ноутбук', 'Ноутбук игровой 15 дюймов', 'Сумка для ноутбука и планшета', 'Мышь']
+    assert total == 4
+
+
+def test_paging_crosses_from_names_to_descriptions(db):
+    _catalog(db)
+    pages = [_names(search_products(db, 'ноут', limit=2, offset=offset)[0]) for offset in (0, 2, 4)]
+    assert pages == [['Ноутбук', 'Ноутбук игровой 15 дюймов'], ['Сумка для ноутбука и планшета', 'Мышь'], []]
+    assert _names(search_products(db, 'ноут', limit=2, offset=3)[0]) == ['Мышь']
+
+
+def test_matches_beyond_rank_window_follow_by_id(db, monkeypatch):
+    _catalog(db)
+    monkeypatch.setattr(search, 'SEARCH_RANK_WINDOW', 2)
+    pages = [_names(search_products(db, 'ноут', limit=2, offset=offset)[0]) for offset in (0, 2)]
+    # В окно попадают два первых по id совпадения в названии, внутри окна
+    # они упорядочены по bm25, третье идёт следом
+    assert pages == [['Ноутбук игровой 15 дюймов', 'Сумка для ноутбука и планшета'], ['Ноутбук', 'Мышь']]
+
+
+def test_category_filter_and_names_only(db):
+    laptops = _catalog(db)
+    products, total = search_products(db, 'ноут', category_id=laptops.id)
+    assert _names(products) == ['Ноутбук', 'Ноутбук игровой 15 дюймов', 'Мышь']
+    assert total == 3
+
+    products, total = search_products(db, 'ноут', names_only=True, limit=8)
+    assert _names(products) == ['Ноутбук', 'Ноутбук игровой 15 дюймов', 'Сумка для ноутбука и планшета']
+    assert total == 3
@@ -0,0 +1,16 @@
+# Точка входа для production-сервера:
+#   gunicorn -c gunicorn.conf.py wsgi:application
+#   waitress-serve --threads 8 wsgi:application (Windows)
+from sqlalchemy.orm import configure_mappers
+from app import app, compile_templates
+
+
+def create_application():
+    # Шаблоны компилируются и маперы SQLAlchemy настраиваются до fork: иначе
+    # это делает первый запрос в каждом воркере
+    compile_templates()
+    configure_mappers()
+    return app
+
+
+application = create_application()